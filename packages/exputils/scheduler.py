@@ -0,0 +1,288 @@
+import os
+import sqlite3
+import subprocess
+import time
+import traceback
+import multiprocessing
+from termcolor import colored
+
+from fair.utils.representations import exported_representations, copy_exported_representations
+
+# stages of the processing of an experiment, in the order they are run. evaluate
+# jobs (one per exported checkpoint) are created once export and baselines are done.
+STAGES = ["train", "baselines", "export", "evaluate"]
+
+# environment variables limiting the threads used by TF and by the BLAS libraries
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    experiment TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    checkpoint TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker INTEGER,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (experiment, stage, checkpoint)
+);
+
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, experiment);
+"""
+
+def parse_num_epochs(num_epochs, granularity=100):
+    try:
+        num_epochs = int(num_epochs)
+        return num_epochs, (num_epochs % granularity) == 0
+    except ValueError:
+        return num_epochs, True
+
+def exported_epochs(exp_dir, granularity=100):
+    """
+    returns the epochs of the checkpoints whose representations have been written by
+    fair_networks --export-all-checkpoints in exp_dir/all_representations, keeping only
+    the multiples of granularity (and 'final'), as process_all does. Each epoch is
+    returned once, also when a population wrote one representation per member.
+    """
+    epochs = exported_representations(os.path.join(exp_dir, 'all_representations')).keys()
+    return sorted(str(epoch) for epoch, check in map(lambda e: parse_num_epochs(e, granularity), epochs) if check)
+
+
+class JobQueue:
+    """
+    Persistent table of the jobs needed to process a set of experiments, one row per
+    (experiment, stage, checkpoint), stored in a SQLite database (in WAL mode, shared
+    by all the workers). Jobs are pending, running, done or failed; the jobs found
+    running when a scheduler starts have been left by a crashed run and are made
+    pending again by reset_running.
+
+    At most one job per experiment runs at any time, since the jobs of an experiment
+    share its representations directory.
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def _add(self, experiment, stage, checkpoint='', status='pending'):
+        self.connection.execute("INSERT OR IGNORE INTO jobs (experiment, stage, checkpoint, status, updated) "
+                                "VALUES (?, ?, ?, ?, ?)", (experiment, stage, str(checkpoint), status, time.time()))
+
+    def _is_done(self, experiment, stage):
+        cursor = self.connection.execute("SELECT 1 FROM jobs WHERE experiment = ? AND stage = ? AND status = 'done'",
+                                         (experiment, stage))
+        return cursor.fetchone() != None
+
+    def add_experiment(self, exp_dir):
+        """
+        adds the jobs of the experiment in exp_dir (if not already there); training is
+        considered done if the final checkpoint exists.
+        """
+        experiment = os.path.abspath(exp_dir)
+        trained = os.path.exists(os.path.join(experiment, 'models', 'model-final.ckpt.index'))
+
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._add(experiment, 'train', status='done' if trained else 'pending')
+            self._add(experiment, 'baselines')
+            if trained:
+                self._add(experiment, 'export')
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def reset_running(self):
+        cursor = self.connection.execute("UPDATE jobs SET status = 'pending', worker = NULL WHERE status = 'running'")
+        return cursor.rowcount
+
+    def retry_failed(self):
+        cursor = self.connection.execute("UPDATE jobs SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+        return cursor.rowcount
+
+    def claim(self, worker):
+        """
+        marks as running and returns, as an (experiment, stage, checkpoint) tuple, a
+        pending job of an experiment having no running job; returns None if there is no
+        such job.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT experiment, stage, checkpoint FROM jobs WHERE status = 'pending' AND experiment NOT IN "
+                "(SELECT experiment FROM jobs WHERE status = 'running') "
+                "ORDER BY CASE stage WHEN 'train' THEN 0 WHEN 'baselines' THEN 1 WHEN 'export' THEN 2 ELSE 3 END, "
+                "attempts, experiment, checkpoint LIMIT 1").fetchone()
+            if row != None:
+                self.connection.execute("UPDATE jobs SET status = 'running', worker = ?, updated = ? "
+                                        "WHERE experiment = ? AND stage = ? AND checkpoint = ?",
+                                        (worker, time.time()) + tuple(row))
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        return None if row == None else tuple(row)
+
+    def complete(self, job, granularity=100):
+        """
+        marks the job as done and adds the jobs depending on it: export after train,
+        and one evaluate job per exported checkpoint once both export and baselines are
+        done.
+        """
+        experiment, stage, checkpoint = job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("UPDATE jobs SET status = 'done', error = NULL, updated = ? "
+                                    "WHERE experiment = ? AND stage = ? AND checkpoint = ?",
+                                    (time.time(), experiment, stage, checkpoint))
+            if stage == 'train':
+                self._add(experiment, 'export')
+            if stage in ['export', 'baselines'] and self._is_done(experiment, 'export') and self._is_done(experiment, 'baselines'):
+                for epoch in exported_epochs(experiment, granularity):
+                    self._add(experiment, 'evaluate', epoch)
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def fail(self, job, error, max_attempts=3):
+        """
+        records the failure of the job, which is made pending again unless it already
+        failed max_attempts times.
+        """
+        experiment, stage, checkpoint = job
+        self.connection.execute("UPDATE jobs SET attempts = attempts + 1, error = ?, updated = ?, "
+                                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                                "WHERE experiment = ? AND stage = ? AND checkpoint = ?",
+                                (error, time.time(), max_attempts, experiment, stage, checkpoint))
+
+    def counts(self):
+        """ returns a dictionary mapping each status to the number of jobs having it """
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def failed(self):
+        return list(self.connection.execute("SELECT experiment, stage, checkpoint, attempts, error FROM jobs "
+                                            "WHERE status = 'failed' ORDER BY experiment, stage, checkpoint"))
+
+    def close(self):
+        self.connection.close()
+
+
+def job_command(job, store_path, threads=1, mi="mine"):
+    """ returns the shell command running the given job """
+    experiment, stage, checkpoint = job
+    config_path = os.path.join(experiment, 'config.json')
+
+    if stage == 'train':
+        return 'git rev-parse HEAD > {dir}/commit-id; fair_networks {config} --log-file={dir}/training.log'.format(
+            dir=experiment, config=config_path)
+    if stage == 'baselines':
+        return ('random_networks {config} -E representations/random_networks_repr && '
+                'copy_original_representation {config} -E representations/original_repr').format(config=config_path)
+    if stage == 'export':
+        return ('fair_networks {} --export-all-checkpoints --representation-format npz '
+                '-E all_representations/fair_networks_repr').format(config_path)
+    if stage == 'evaluate':
+        return 'test_representations {} -j {} --mi {} --store {} --epoch {}'.format(
+            experiment, threads, mi, store_path, checkpoint)
+
+    raise ValueError("unknown stage: {}".format(stage))
+
+def prepare_job(job):
+    """
+    copies the representations of the checkpoint evaluated by an evaluate job (those
+    of every member, for a population) where test_representations reads them
+    """
+    experiment, stage, checkpoint = job
+    if stage != 'evaluate':
+        return
+
+    copy_exported_representations(os.path.join(experiment, 'all_representations'),
+                                  os.path.join(experiment, 'representations'), checkpoint)
+
+def thread_environment(threads):
+    env = dict(os.environ)
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(threads)
+    return env
+
+def run_worker(worker, queue_path, store_path, cores, threads=1, max_attempts=3, mi="mine", granularity=100, poll_interval=5.0):
+    """
+    runs jobs claimed from the queue until there are neither pending nor running
+    jobs. The worker (and the commands it launches) is pinned to the given cores;
+    TF and the BLAS libraries are limited to threads threads.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    env = thread_environment(threads)
+    queue = JobQueue(queue_path)
+
+    while True:
+        job = queue.claim(worker)
+        if job == None:
+            counts = queue.counts()
+            if counts.get('pending', 0) == 0 and counts.get('running', 0) == 0:
+                break
+            # jobs of experiments being processed by other workers, or following them
+            time.sleep(poll_interval)
+            continue
+
+        experiment, stage, checkpoint = job
+        print(colored('[worker {}] {} {} {}'.format(worker, stage, experiment, checkpoint), "green"))
+        try:
+            prepare_job(job)
+            returncode = subprocess.call(job_command(job, store_path, threads, mi), shell=True, cwd=experiment, env=env)
+            error = None if returncode == 0 else 'exit status {}'.format(returncode)
+        except Exception:
+            error = traceback.format_exc()
+
+        if error == None:
+            queue.complete(job, granularity)
+        else:
+            print(colored('[worker {}] {} {} {} failed: {}'.format(worker, stage, experiment, checkpoint, error), "red"))
+            queue.fail(job, error, max_attempts)
+
+    queue.close()
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def core_groups(num_workers, threads):
+    """
+    partitions the cores available to this process into num_workers groups of threads
+    cores (groups wrap around if there are not enough cores)
+    """
+    cores = available_cores()
+    return [set(cores[(worker * threads + i) % len(cores)] for i in range(threads)) for worker in range(num_workers)]
+
+def run(queue_path, store_path, num_workers=None, threads=1, max_attempts=3, mi="mine", granularity=100):
+    """
+    resumes the jobs left running by a previous (crashed) run and processes all the
+    jobs in the queue with num_workers worker processes (by default, as many as fit the
+    available cores with threads threads each).
+    """
+    queue = JobQueue(queue_path)
+    resumed = queue.reset_running()
+    queue.close()
+    if resumed > 0:
+        print(colored('Resuming {} jobs left running'.format(resumed), "yellow"))
+
+    if num_workers == None:
+        num_workers = max(1, len(available_cores()) // threads)
+
+    workers = [multiprocessing.Process(target=run_worker,
+                                       args=(worker, queue_path, store_path, cores, threads, max_attempts, mi, granularity))
+               for worker, cores in enumerate(core_groups(num_workers, threads))]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
@@ -1,11 +1,8 @@
 import csv
-import requests
 import os.path
-import tensorflow as tf
 import numpy as np
 import logging
 
-from tqdm import tqdm
 
 from .dataset_base import DatasetBase
 
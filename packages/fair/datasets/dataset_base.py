@@ -1,25 +1,32 @@
 import csv
-import requests
 import os.path
-import tensorflow as tf
+import shutil
 import numpy as np
 import zipfile
 import pandas
-import sklearn
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import MinMaxScaler
+import scipy.sparse
 from termcolor import colored
 import logging
 
-from tqdm import tqdm
+from fair.datasets.dataset_cache import DatasetCache
+from fair.datasets.streaming_loader import StreamingLoader
+
+# tensorflow, sklearn, requests and tqdm are imported only by the methods using them:
+# datasets read from the cache need none of them
 
 
 class DatasetBase:
-    def __init__(self, workingdir, existing_split=False):
+    # dtypes used to store examples (xs) and one-hot encoded labels (ys and s)
+    XS_DTYPE = np.float32
+    LABELS_DTYPE = np.uint8
+
+    def __init__(self, workingdir, existing_split=False, use_cache=True, streaming=False):
         """
         Downloads and load into memory the dataset.
         """
         self.workingdir = workingdir
+        self.use_cache = use_cache
+        self.streaming = streaming
         self.download_all()
         self.prepare_all()
         self.load_all()
@@ -45,6 +52,12 @@ class DatasetBase:
     def y_columns(self):
         return []
 
+    def data_paths(self):
+        """
+        returns the list of files the dataset is loaded from
+        """
+        return [self.dataset_path()]
+
     def sep(self):
         return ';'
 
@@ -57,6 +70,22 @@ class DatasetBase:
     def split_val_size(self):
         return 0.1
 
+    def split_random_state(self):
+        return 42
+
+    def sparse(self):
+        """
+        returns True if the examples (xs) should be loaded and stored as a
+        scipy.sparse CSR matrix (see load_sparse_data)
+        """
+        return False
+
+    def sparse_chunk_size(self):
+        return 1000
+
+    def streaming_chunk_size(self):
+        return 100000
+
     def load_data(self, path):
         """
         Loads the file specified by the path parameter, parses it
@@ -84,6 +113,7 @@ class DatasetBase:
 
 
         logging.info("Scaling values for columns: {}".format(list(non_hot_cols)))
+        from sklearn.preprocessing import MinMaxScaler
         scaler = MinMaxScaler()
         df[non_hot_cols] = scaler.fit_transform(df[non_hot_cols].astype(np.float64))
 
@@ -93,6 +123,11 @@ class DatasetBase:
 
         self._num_s_columns = len(s_1h_col_names)
         self._num_y_columns = len(y_1h_col_names)
+        self._column_names = {
+            "xs": [str(col) for col in all_non_y_non_s_names],
+            "ys": [str(col) for col in y_1h_col_names],
+            "s": [str(col) for col in s_1h_col_names]
+        }
 
         xs = df[all_non_y_non_s_names]
         ys = df[y_1h_col_names]
@@ -104,12 +139,79 @@ class DatasetBase:
         return (xs.values, ys.values, s.values)
 
 
+    def load_sparse_data(self, path):
+        """
+        Sparse alternative to load_data, meant for very wide datasets (e.g., bag of words).
+        Returns a tuple (xs,ys,s) where xs is a scipy.sparse CSR matrix.
+
+        The file is read in chunks of sparse_chunk_size() rows, each chunk being converted
+        to a CSR matrix as soon as it is read, so that the dense representation of the
+        whole dataset is never built. Columns not listed in one_hot_columns() are scaled
+        by their maximum absolute value: zero entries are left untouched (and hence
+        sparsity is preserved) and, for non-negative columns, the result is the same as
+        the min-max scaling performed by load_data.
+        """
+        logging.info("Reading dataset (sparse): {}".format(path))
+
+        s_col_names = self.sensible_columns()
+        y_col_names = self.y_columns()
+
+        assert len(s_col_names) <= 1, "multiple s columns not yet supported"
+        assert len(y_col_names) <= 1, "multiple y columns not yet supported"
+
+        one_hot_cols = list(self.one_hot_columns())
+        non_hot_cols = [col for col in self.all_columns() if col not in one_hot_cols]
+
+        xs_chunks = []
+        one_hot_chunks = []
+        for chunk in pandas.read_csv(path, sep=self.sep(), chunksize=self.sparse_chunk_size()):
+            xs_chunks.append(scipy.sparse.csr_matrix(chunk[non_hot_cols].values.astype(self.XS_DTYPE)))
+            one_hot_chunks.append(chunk[one_hot_cols])
+
+        logging.info("Scaling values for {} columns".format(len(non_hot_cols)))
+        from sklearn.preprocessing import MaxAbsScaler
+        xs = MaxAbsScaler().fit_transform(scipy.sparse.vstack(xs_chunks, format='csr'))
+
+        logging.info("Getting dummy variables for columns: {}".format(one_hot_cols))
+        dummies = pandas.get_dummies(pandas.concat(one_hot_chunks, axis=0), columns=one_hot_cols)
+
+        s_1h_col_names = [col for col in dummies.columns for s_col_name in s_col_names if col.startswith(s_col_name + "_")]
+        y_1h_col_names = [col for col in dummies.columns for y_col_name in y_col_names if col.startswith(y_col_name + "_")]
+        x_1h_col_names = [col for col in dummies.columns if col not in s_1h_col_names and col not in y_1h_col_names]
+
+        if len(x_1h_col_names) > 0:
+            x_1h = scipy.sparse.csr_matrix(dummies[x_1h_col_names].values.astype(self.XS_DTYPE))
+            xs = scipy.sparse.hstack([xs, x_1h], format='csr')
+
+        self._num_s_columns = len(s_1h_col_names)
+        self._num_y_columns = len(y_1h_col_names)
+        self._column_names = {
+            "xs": [str(col) for col in non_hot_cols + x_1h_col_names],
+            "ys": [str(col) for col in y_1h_col_names],
+            "s": [str(col) for col in s_1h_col_names]
+        }
+
+        ys = dummies[y_1h_col_names]
+        s = dummies[s_1h_col_names]
+
+        logging.debug("y values sums:{}".format(list(ys.sum(axis=0))))
+        logging.debug("s values sums:{}".format(list(s.sum(axis=0))))
+
+        return (xs, ys.values, s.values)
+
     def num_s_columns(self):
         return self._num_s_columns
 
     def num_y_columns(self):
         return self._num_y_columns
 
+    def column_names(self):
+        """
+        returns a dictionary mapping "xs", "ys" and "s" to the names of the
+        corresponding (one-hot encoded) columns
+        """
+        return self._column_names
+
     def sample_examples(self, xs, ys, class_vec, num_elems):
         class_examples = np.where(ys == class_vec)[0]
         extracted = np.random.choice(class_examples, num_elems, replace=True)
@@ -148,23 +250,173 @@ class DatasetBase:
         """
         loads into memory the training, validation and test sets (it needs to
         be called before accessing to them using other methods that
-        access to the train and the test set)
+        access to the train and the test set).
+
+        Unless the dataset has been created with use_cache=False, the preprocessed
+        splits are saved into (and, when available, read from) a DatasetCache
+        living in the dataset working directory.
+
+        When the dataset has been created with streaming=True, the data files are
+        read in chunks and encoded directly into the cache (see StreamingLoader),
+        so that datasets larger than the available memory can be used.
+        """
+        if self.streaming and not self.use_cache:
+            logging.warning("Streaming load requires the dataset cache: ignoring use_cache=False")
+            self.use_cache = True
+
+        cache = DatasetCache(self) if self.use_cache else None
+
+        if cache is not None and not cache.exists() and self.streaming:
+            self._stream_into_cache(cache)
+
+        if cache is None or not cache.exists():
+            splits, meta = self._preprocess_and_split()
+
+            if cache is None:
+                self._set_splits(splits["train"], splits["val"], splits["test"])
+                return
+
+            cache.save(splits, meta)
+
+        splits, meta = cache.load()
+
+        self._num_s_columns = meta["num_s_columns"]
+        self._num_y_columns = meta["num_y_columns"]
+        self._column_names = meta["column_names"]
+
+        self._set_splits(splits["train"], splits["val"], splits["test"])
+
+    def _preprocess_and_split(self):
+        """
+        loads the dataset from disk and splits it into training, validation and
+        test sets. Returns a tuple (splits, meta) in the format expected by
+        DatasetCache.save.
+        """
+        if self.sparse():
+            xs,ys,s = self.load_sparse_data(self.dataset_path())
+        else:
+            xs,ys,s = self.load_data(self.dataset_path())
+
+        xs,ys,s = self._native_arrays((xs, ys, s))
+
+        test_size = self.split_test_size()
+        val_size = self.split_val_size()/(1.0-test_size)
+        random_state = self.split_random_state()
+
+        from sklearn.model_selection import train_test_split
+        train_xs, test_xs, train_ys, test_ys, train_s, test_s = train_test_split(xs,ys,s,test_size=test_size, random_state=random_state)
+        train_xs, val_xs, train_ys, val_ys, train_s, val_s = train_test_split(train_xs, train_ys, train_s, test_size=val_size, random_state=random_state)
+
+        splits = {
+            "train": (train_xs, train_ys, train_s),
+            "val": (val_xs, val_ys, val_s),
+            "test": (test_xs, test_ys, test_s)
+        }
+
+        meta = {
+            "num_s_columns": self._num_s_columns,
+            "num_y_columns": self._num_y_columns,
+            "column_names": self._column_names
+        }
+
+        return splits, meta
+
+    def _stream_into_cache(self, cache):
+        """
+        streaming counterpart of _preprocess_and_split: each row of the data file is
+        encoded and written directly into its split (the same split it would
+        have been assigned to by _preprocess_and_split) in a new cache entry.
         """
-        xs,ys,s = self.load_data(self.dataset_path())
+        assert not self.sparse(), "streaming load of sparse datasets not yet supported"
+
+        path = self.dataset_path()
+        loader = StreamingLoader(self, self.streaming_chunk_size())
+        loader.fit([path])
 
         test_size = self.split_test_size()
         val_size = self.split_val_size()/(1.0-test_size)
+        random_state = self.split_random_state()
+
+        # splitting the row indices yields the same permutations obtained splitting the data
+        indices = np.arange(loader.num_rows[path])
+        from sklearn.model_selection import train_test_split
+        train_indices, test_indices = train_test_split(indices, test_size=test_size, random_state=random_state)
+        train_indices, val_indices = train_test_split(train_indices, test_size=val_size, random_state=random_state)
+
+        self._write_streamed_splits(cache, loader, [(path, {"train": train_indices, "val": val_indices, "test": test_indices})])
+
+    def _write_streamed_splits(self, cache, loader, sources):
+        """
+        writes a new cache entry. sources is a list of (path, split_indices) pairs,
+        split_indices mapping split names to the (ordered) indices of the rows of
+        the file in path belonging to that split. Splits not mentioned in any source
+        are filled with a single all-zeros example.
+        """
+        split_sizes = {split: 1 for split in DatasetCache.SPLITS}
+        for _, split_indices in sources:
+            split_sizes.update({split: len(indices) for split, indices in split_indices.items()})
+
+        dtypes = [self.XS_DTYPE, self.LABELS_DTYPE, self.LABELS_DTYPE]
+        tmp_path = cache.begin()
+
+        try:
+            outputs = {}
+            for split in DatasetCache.SPLITS:
+                shapes = loader.shapes(split_sizes[split])
+                outputs[split] = tuple(cache.open_array(tmp_path, split, part, dtype, shape)
+                                       for part, dtype, shape in zip(DatasetCache.PARTS, dtypes, shapes))
+
+            for path, split_indices in sources:
+                splits = list(split_indices.keys())
+                split_of = np.empty(loader.num_rows[path], dtype=np.int8)
+                position_of = np.empty(loader.num_rows[path], dtype=np.int64)
+
+                for split_id, split in enumerate(splits):
+                    split_of[split_indices[split]] = split_id
+                    position_of[split_indices[split]] = np.arange(len(split_indices[split]))
+
+                loader.write(path, [outputs[split] for split in splits], split_of, position_of)
+
+            del outputs
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        column_names = loader.column_names()
+        cache.commit(tmp_path, {
+            "num_s_columns": len(column_names["s"]),
+            "num_y_columns": len(column_names["ys"]),
+            "column_names": column_names
+        })
+
+    def _native_arrays(self, data):
+        """
+        converts a tuple (xs,ys,s) into contiguous arrays of the dtypes used to store
+        the dataset (no copy is made when the arrays are already in that format, e.g.,
+        when they are memory mapped from the dataset cache). Sparse examples are
+        kept as CSR matrices.
+        """
+        xs, ys, s = data
 
-        train_xs, test_xs, train_ys, test_ys, train_s, test_s = train_test_split(xs,ys,s,test_size=test_size, random_state=42)
-        train_xs, val_xs, train_ys, val_ys, train_s, val_s = train_test_split(train_xs, train_ys, train_s, test_size=val_size, random_state=42)
+        if scipy.sparse.issparse(xs):
+            xs = scipy.sparse.csr_matrix(xs, dtype=self.XS_DTYPE)
+        else:
+            xs = np.ascontiguousarray(xs, dtype=self.XS_DTYPE)
+
+        return (xs,
+                np.ascontiguousarray(ys, dtype=self.LABELS_DTYPE),
+                np.ascontiguousarray(s, dtype=self.LABELS_DTYPE))
 
-        self._traindata = (train_xs, train_ys, train_s)
-        self._valdata = (val_xs, val_ys, val_s)
-        self._testdata = (test_xs, test_ys, test_s)
+    def _set_splits(self, traindata, valdata, testdata):
+        self._traindata = self._native_arrays(traindata)
+        self._valdata = self._native_arrays(valdata)
+        self._testdata = self._native_arrays(testdata)
 
-        self._train_dataset = tf.data.Dataset.from_tensor_slices(self._traindata)
-        self._val_dataset = tf.data.Dataset.from_tensor_slices(self._valdata)
-        self._test_dataset = tf.data.Dataset.from_tensor_slices(self._testdata)
+        # tf.data.Dataset objects are built lazily (see train_dataset & co.) so that
+        # tools not needing them do not pay for an additional copy of the data
+        self._train_dataset = None
+        self._val_dataset = None
+        self._test_dataset = None
 
 
     def load_all_with_validation(self):
@@ -176,13 +428,7 @@ class DatasetBase:
         test_xs, test_ys, test_s = self.load_data(self.test_path())
         val_xs, val_ys, val_s = self.load_data(self.val_path())
 
-        self._traindata = (train_xs, train_ys, train_s)
-        self._testdata = (test_xs, test_ys, test_s)
-        self._valdata = (val_xs, val_ys, val_s)
-
-        self._train_dataset = tf.data.Dataset.from_tensor_slices(self._traindata)
-        self._test_dataset = tf.data.Dataset.from_tensor_slices(self._testdata)
-        self._val_dataset = tf.data.Dataset.from_tensor_slices(self._valdata)
+        self._set_splits((train_xs, train_ys, train_s), (val_xs, val_ys, val_s), (test_xs, test_ys, test_s))
 
 
     def download(self, url, filename):
@@ -194,6 +440,9 @@ class DatasetBase:
             logging.info(filename + " already exists. Skipping download.")
             return
 
+        import requests
+        from tqdm import tqdm
+
         logging.info("Downloading {}".format(url))
         dataset = requests.get(url)
     
@@ -231,41 +480,63 @@ class DatasetBase:
     def num_features(self):
         return self._traindata[0].shape[1]
 
+    def _tensors(self, data):
+        xs, ys, s = data
+
+        if scipy.sparse.issparse(xs):
+            from fair.utils.sparse_utils import to_sparse_tensor
+            xs = to_sparse_tensor(xs)
+
+        return (xs, ys, s)
+
     def train_dataset(self):
         """
         returns a tf.data.Dataset built from the training set
         """
+        if self._train_dataset is None:
+            import tensorflow as tf
+            self._train_dataset = tf.data.Dataset.from_tensor_slices(self._tensors(self._traindata))
+
         return self._train_dataset
 
     def val_dataset(self):
         """
         returns a tf.data.Dataset built from the validation set
         """
+        if self._val_dataset is None:
+            import tensorflow as tf
+            self._val_dataset = tf.data.Dataset.from_tensor_slices(self._tensors(self._valdata))
+
         return self._val_dataset
 
     def test_dataset(self):
         """
         returns a tf.data.Dataset built from the test set
         """
+        if self._test_dataset is None:
+            import tensorflow as tf
+            self._test_dataset = tf.data.Dataset.from_tensor_slices(self._tensors(self._testdata))
+
         return self._test_dataset
 
     def train_all_data(self):
         """
-        returns the whole training set as a tuple of numpy arrays (xs,ys,s)
+        returns the whole training set as a tuple of numpy arrays (xs,ys,s).
+        Arrays are views on the stored data (no copy is made) and must be
+        treated as read-only.
         """
-        xs,ys,s = self._traindata
-        return (np.array(xs), np.array(ys), np.array(s))
+        return self._traindata
 
     def val_all_data(self):
         """
-        returns the whole training set as a tuple of numpy arrays (xs,ys,s)
+        returns the whole validation set as a tuple of numpy arrays (xs,ys,s)
+        (read-only views, see train_all_data)
         """
-        xs, ys, s = self._valdata
-        return (np.array(xs), np.array(ys), np.array(s))
+        return self._valdata
 
     def test_all_data(self):
         """
         returns the whole test set as a tuple of numpy arrays (xs,ys,s)
+        (read-only views, see train_all_data)
         """
-        xs,ys,s = self._testdata
-        return (np.array(xs), np.array(ys), np.array(s))
+        return self._testdata
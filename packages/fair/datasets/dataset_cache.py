@@ -0,0 +1,173 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+import numpy as np
+import scipy.sparse
+
+
+class DatasetCache:
+    """
+    Content-addressed on-disk cache of preprocessed datasets.
+
+    The cache stores the final train/val/test arrays (as .npy files, using float32
+    for the examples and uint8 for the one-hot encoded labels) and the column
+    metadata produced by DatasetBase.load_data. Entries are keyed on the hash of
+    the raw data file together with every option influencing the preprocessing
+    (columns specs, separator, split sizes and split seed), so that a stale entry
+    is never returned: changing any of them simply produces a new key.
+
+    Cached arrays are loaded with np.load(mmap_mode='r'), i.e., a warm start
+    does not need to parse (nor to keep in memory) the original csv file. Sparse
+    (CSR) matrices are stored as their data, indices and indptr arrays, which are
+    memory mapped as well.
+    """
+
+    # bump this whenever the preprocessing code changes in a way that
+    # invalidates previously cached arrays
+    VERSION = 3
+
+    SPLITS = ["train", "val", "test"]
+    PARTS = ["xs", "ys", "s"]
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def cache_dir(self):
+        return os.path.join(self.dataset.workingdir, "cache")
+
+    def key(self):
+        """
+        Returns the key identifying the cache entry for the dataset in its current
+        configuration.
+        """
+        digest = hashlib.sha1()
+        for path in self.dataset.data_paths():
+            digest.update(self._file_hash(path).encode("utf8"))
+        digest.update(json.dumps(self._specs(), sort_keys=True).encode("utf8"))
+
+        return "{}-{}".format(self.dataset.name().replace(" ", "_"), digest.hexdigest())
+
+    def entry_path(self):
+        return os.path.join(self.cache_dir(), self.key())
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.entry_path(), "meta.json"))
+
+    def load(self):
+        """
+        Returns a tuple (splits, meta) where splits is a dictionary mapping each split
+        name to a tuple (xs, ys, s) of read-only memory mapped arrays, and meta is the
+        dictionary of column metadata saved along with them.
+        """
+        path = self.entry_path()
+        logging.info("Loading preprocessed dataset from cache: {}".format(path))
+
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        splits = {}
+        for split in self.SPLITS:
+            splits[split] = tuple(self._load_array(path, "{}_{}".format(split, part), meta)
+                                  for part in self.PARTS)
+
+        return splits, meta
+
+    def save(self, splits, meta):
+        """
+        Stores the given splits (a dictionary mapping each split name to a tuple
+        (xs, ys, s)) and metadata into the cache. Arrays are written with their
+        own dtype (see DatasetBase._native_arrays).
+        """
+        tmp_path = self.begin()
+        meta = dict(meta, sparse_shapes={})
+
+        try:
+            for split in self.SPLITS:
+                for part, data in zip(self.PARTS, splits[split]):
+                    self._save_array(tmp_path, "{}_{}".format(split, part), data, meta)
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.commit(tmp_path, meta)
+
+    def begin(self):
+        """
+        Starts writing a new entry. Returns the path of a temporary directory where
+        arrays should be written (e.g., using open_array); the entry becomes visible
+        only when commit is called.
+
+        Entries are first written in a temporary directory and then moved into place,
+        so that concurrent processes never read partially written entries.
+        """
+        os.makedirs(self.cache_dir(), exist_ok=True)
+        logging.info("Saving preprocessed dataset into cache: {}".format(self.entry_path()))
+
+        return tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir())
+
+    def open_array(self, tmp_path, split, part, dtype, shape):
+        """
+        Creates (in an entry being written) a memory mapped array for the given
+        split and part, allowing it to be filled without keeping it in memory.
+        """
+        path = os.path.join(tmp_path, "{}_{}.npy".format(split, part))
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def commit(self, tmp_path, meta):
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, self.entry_path())
+        except OSError:
+            # another process may have completed the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not self.exists():
+                raise
+
+    # PRIVATE METHODS
+
+    def _specs(self):
+        ds = self.dataset
+        return {
+            "version": self.VERSION,
+            "class": type(ds).__name__,
+            "all_columns": list(ds.all_columns()),
+            "one_hot_columns": list(ds.one_hot_columns()),
+            "sensible_columns": list(ds.sensible_columns()),
+            "y_columns": list(ds.y_columns()),
+            "sep": ds.sep(),
+            "sparse": ds.sparse(),
+            "split_test_size": ds.split_test_size(),
+            "split_val_size": ds.split_val_size(),
+            "split_random_state": ds.split_random_state()
+        }
+
+    def _save_array(self, path, name, data, meta):
+        if not scipy.sparse.issparse(data):
+            np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(data))
+            return
+
+        data = data.tocsr()
+        meta["sparse_shapes"][name] = list(data.shape)
+        for component in ["data", "indices", "indptr"]:
+            np.save(os.path.join(path, "{}.{}.npy".format(name, component)), getattr(data, component))
+
+    def _load_array(self, path, name, meta):
+        if name not in meta.get("sparse_shapes", {}):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+        components = [np.load(os.path.join(path, "{}.{}.npy".format(name, component)), mmap_mode='r')
+                      for component in ["data", "indices", "indptr"]]
+        return scipy.sparse.csr_matrix(tuple(components), shape=meta["sparse_shapes"][name], copy=False)
+
+    def _file_hash(self, path, block_size=1 << 20):
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+
+        return digest.hexdigest()
@@ -1,18 +1,12 @@
 import csv
-import requests
 import os.path
-import tensorflow as tf
 import numpy as np
 import zipfile
 import pandas
-import sklearn
 import logging
 
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 from fair.datasets.dataset_base import DatasetBase
 
-from tqdm import tqdm
 
 
 class DefaultDataset(DatasetBase):
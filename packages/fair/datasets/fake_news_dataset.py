@@ -1,18 +1,12 @@
 import csv
-import requests
 import os.path
-import tensorflow as tf
 import numpy as np
 import zipfile
 import pandas
-import sklearn
 import logging
 
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 from fair.datasets.dataset_base import DatasetBase
 
-from tqdm import tqdm
 
 
 class FakeNewsDataset(DatasetBase):
@@ -21,14 +15,11 @@ class FakeNewsDataset(DatasetBase):
     """
     Helper class allowing to download and load into memory the fake news dataset
     """
-    def __init__(self, workingdir, existing_split=False):
+    def __init__(self, workingdir, existing_split=False, use_cache=True, streaming=False):
         """
         Downloads and load into memory the dataset.
         """
-        self.workingdir = workingdir
-        self.download_all()
-        self.prepare_all()
-        self.load_all()
+        super().__init__(workingdir, existing_split, use_cache, streaming)
 
     def name(self):
         return "FakeNews"
@@ -46,6 +37,9 @@ class FakeNewsDataset(DatasetBase):
     def y_columns(self):
         return ["y"]
 
+    def sparse(self):
+        return True
+
     def dataset_path(self):
         return '%s/fakenews.csv' % (self.workingdir)
 
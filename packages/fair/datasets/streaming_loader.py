@@ -0,0 +1,164 @@
+import logging
+import numpy as np
+import pandas
+
+
+class StreamingLoader:
+    """
+    Two-pass, chunked alternative to DatasetBase.load_data for datasets that do not
+    fit into memory.
+
+    The first pass (fit) reads the csv files chunk by chunk collecting the vocabulary
+    of each one-hot column and the min/max statistics of the columns to be scaled.
+    The second pass (write) encodes each chunk and writes the resulting rows into
+    (memory mapped) output arrays. Peak memory is thus bounded by the chunk size
+    (plus a couple of integers per row to route rows to their destination).
+
+    The encoding replicates the one performed by DatasetBase.load_data (same
+    columns, in the same order, and same min-max scaling), so that the arrays
+    produced by the two methods are the same.
+    """
+
+    def __init__(self, dataset, chunk_size):
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+
+    def fit(self, paths, scaling_paths=None):
+        """
+        First pass: collects vocabularies and (over scaling_paths only, defaults to
+        all paths) the statistics needed to scale the values.
+        """
+        if scaling_paths is None:
+            scaling_paths = paths
+
+        self.one_hot_cols = list(self.dataset.one_hot_columns())
+        self.non_hot_cols = [col for col in self.dataset.all_columns() if col not in self.one_hot_cols]
+
+        vocabularies = {col: set() for col in self.one_hot_cols}
+        data_min = np.full(len(self.non_hot_cols), np.nan)
+        data_max = np.full(len(self.non_hot_cols), np.nan)
+        self.num_rows = {}
+        self.file_columns = None
+
+        for path in paths:
+            logging.info("Collecting statistics (streaming): {}".format(path))
+            num_rows = 0
+
+            for chunk in self._chunks(path):
+                if self.file_columns is None:
+                    self.file_columns = list(chunk.columns)
+
+                num_rows += len(chunk)
+                for col in self.one_hot_cols:
+                    vocabularies[col].update(chunk[col].dropna().unique())
+
+                if path in scaling_paths:
+                    values = chunk[self.non_hot_cols].values.astype(np.float64)
+                    data_min = np.fmin(data_min, np.nanmin(values, axis=0))
+                    data_max = np.fmax(data_max, np.nanmax(values, axis=0))
+
+            self.num_rows[path] = num_rows
+
+        self.vocabularies = {col: sorted(values) for col, values in vocabularies.items()}
+        self._set_scaling(data_min, data_max)
+        self._set_columns()
+
+    def column_names(self):
+        """
+        returns a dictionary mapping "xs", "ys" and "s" to the names of the
+        corresponding (one-hot encoded) columns (same format as DatasetBase.column_names)
+        """
+        return {
+            "xs": [str(self.columns[i]) for i in self.xs_indices],
+            "ys": [str(self.columns[i]) for i in self.ys_indices],
+            "s": [str(self.columns[i]) for i in self.s_indices]
+        }
+
+    def shapes(self, num_rows):
+        """
+        returns the shapes of the (xs, ys, s) arrays for a split of num_rows rows
+        """
+        return ((num_rows, len(self.xs_indices)), (num_rows, len(self.ys_indices)), (num_rows, len(self.s_indices)))
+
+    def write(self, path, outputs, split_of, position_of):
+        """
+        Second pass: encodes the file in the given path and writes each of its rows
+        into the outputs. outputs is a list of (xs, ys, s) tuples of arrays; the i-th
+        row of the file is written in outputs[split_of[i]] at position position_of[i].
+        """
+        logging.info("Encoding dataset (streaming): {}".format(path))
+        start = 0
+
+        for chunk in self._chunks(path):
+            encoded = self.transform(chunk)
+            rows = np.arange(start, start + len(chunk))
+            start += len(chunk)
+
+            for split, output in enumerate(outputs):
+                mask = split_of[rows] == split
+                if not mask.any():
+                    continue
+
+                positions = position_of[rows[mask]]
+                for out_array, values in zip(output, encoded):
+                    out_array[positions] = values[mask]
+
+        for output in outputs:
+            for out_array in output:
+                if isinstance(out_array, np.memmap):
+                    out_array.flush()
+
+    def transform(self, chunk):
+        """
+        encodes a chunk (a pandas.DataFrame) returning the tuple (xs, ys, s)
+        """
+        values = np.zeros((len(chunk), len(self.columns)), dtype=np.float64)
+        values[:, :len(self.raw_cols)] = chunk[self.raw_cols].values.astype(np.float64)
+
+        scaled = values[:, self.scaled_indices]
+        scaled *= self.scale
+        scaled += self.offset
+        values[:, self.scaled_indices] = scaled
+
+        column = len(self.raw_cols)
+        rows = np.arange(len(chunk))
+        for col in self.one_hot_cols:
+            vocabulary = self.vocabularies[col]
+            codes = pandas.Categorical(chunk[col], categories=vocabulary).codes
+            known = codes >= 0
+            values[rows[known], column + codes[known]] = 1.0
+            column += len(vocabulary)
+
+        return (values[:, self.xs_indices], values[:, self.ys_indices], values[:, self.s_indices])
+
+    # PRIVATE METHODS
+
+    def _chunks(self, path):
+        return pandas.read_csv(path, sep=self.dataset.sep(), chunksize=self.chunk_size)
+
+    def _set_scaling(self, data_min, data_max):
+        # same computation performed by sklearn's MinMaxScaler
+        data_range = data_max - data_min
+        data_range[data_range == 0.0] = 1.0
+        self.scale = 1.0 / data_range
+        self.offset = -data_min * self.scale
+
+    def _set_columns(self):
+        # pandas.get_dummies keeps non encoded columns (in their original order) and
+        # appends the dummy columns for each one-hot column
+        self.raw_cols = [col for col in self.file_columns if col not in self.one_hot_cols]
+        dummy_cols = ["{}_{}".format(col, value) for col in self.one_hot_cols for value in self.vocabularies[col]]
+        self.columns = self.raw_cols + dummy_cols
+        raw_positions = {col: i for i, col in enumerate(self.raw_cols)}
+        self.scaled_indices = [raw_positions[col] for col in self.non_hot_cols]
+
+        s_col_names = self.dataset.sensible_columns()
+        y_col_names = self.dataset.y_columns()
+
+        assert len(s_col_names) <= 1, "multiple s columns not yet supported"
+        assert len(y_col_names) <= 1, "multiple y columns not yet supported"
+
+        self.s_indices = [i for name in s_col_names for i, col in enumerate(self.columns) if str(col).startswith(name)]
+        self.ys_indices = [i for name in y_col_names for i, col in enumerate(self.columns) if str(col).startswith(name)]
+        labels_indices = set(self.s_indices) | set(self.ys_indices)
+        self.xs_indices = [i for i in range(len(self.columns)) if i not in labels_indices]
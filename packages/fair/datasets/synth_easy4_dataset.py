@@ -1,9 +1,5 @@
 from .dataset_base import DatasetBase
 import pandas
-import sklearn
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import MinMaxScaler
-import tensorflow as tf
 import numpy as np
 
 
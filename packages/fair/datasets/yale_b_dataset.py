@@ -1,19 +1,14 @@
 import csv
-import requests
 import os.path
-import tensorflow as tf
 import numpy as np
 import pandas as pd
 import logging
 import tarfile
 import pickle
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
 
-from tqdm import tqdm
 
 from .dataset_base import DatasetBase
+from .streaming_loader import StreamingLoader
 
 class YaleBDataset(DatasetBase):
     """
@@ -132,10 +127,13 @@ class YaleBDataset(DatasetBase):
     def test_path(self):
         return "%s/yale_test.csv"  % (self.workingdir)
 
-    def load_all(self):
+    def data_paths(self):
+        return [self.train_path(), self.test_path()]
+
+    def _preprocess_and_split(self):
         """
-        An alternative to load_all where the dataset has already been separated into 
-        train and test files.
+        An alternative to DatasetBase._preprocess_and_split where the dataset has already
+        been separated into train and test files.
         """
         (train_xs, train_ys, train_s), (val_xs, val_ys,val_s) = self.load_data_separate_paths(self.train_path(), self.test_path())
 
@@ -151,14 +149,33 @@ class YaleBDataset(DatasetBase):
                                   np.zeros([1, train_s.shape[1]]))
 
         # train_xs, val_xs, train_ys, val_ys, train_s, val_s = train_test_split(train_xs, train_ys, train_s, test_size=0.2)
-        
-        self._traindata = (train_xs, train_ys, train_s)
-        self._valdata = (val_xs, val_ys, val_s)
-        self._testdata = (test_xs, test_ys, test_s)
 
-        self._train_dataset = tf.data.Dataset.from_tensor_slices(self._traindata)
-        self._val_dataset = tf.data.Dataset.from_tensor_slices(self._valdata)
-        self._test_dataset = tf.data.Dataset.from_tensor_slices(self._testdata)
+        splits = {
+            "train": self._native_arrays((train_xs, train_ys, train_s)),
+            "val": self._native_arrays((val_xs, val_ys, val_s)),
+            "test": self._native_arrays((test_xs, test_ys, test_s))
+        }
+
+        meta = {
+            "num_s_columns": self._num_s_columns,
+            "num_y_columns": self._num_y_columns,
+            "column_names": self._column_names
+        }
+
+        return splits, meta
+
+    def _stream_into_cache(self, cache):
+        """
+        Streaming counterpart of _preprocess_and_split: scaling statistics are computed
+        on the train file only, the test file is used as validation set.
+        """
+        loader = StreamingLoader(self, self.streaming_chunk_size())
+        loader.fit([self.train_path(), self.test_path()], scaling_paths=[self.train_path()])
+
+        self._write_streamed_splits(cache, loader, [
+            (self.train_path(), {"train": np.arange(loader.num_rows[self.train_path()])}),
+            (self.test_path(), {"val": np.arange(loader.num_rows[self.test_path()])})
+        ])
 
     def column_indices(self, df, cols):
         return [df.columns.get_loc(col) for col in cols]
@@ -197,6 +214,7 @@ class YaleBDataset(DatasetBase):
         train_dataset_non_hot = df.iloc[:num_train_examples, non_hot_cols_indices]
         test_dataset_non_hot = df.iloc[num_train_examples:, non_hot_cols_indices]
 
+        from sklearn.preprocessing import MinMaxScaler
         scaler = MinMaxScaler()
         df.iloc[:num_train_examples, non_hot_cols_indices] = scaler.fit_transform(train_dataset_non_hot.astype(np.float64))
         df.iloc[num_train_examples:, non_hot_cols_indices] = scaler.transform(test_dataset_non_hot.astype(np.float64))
@@ -212,6 +230,11 @@ class YaleBDataset(DatasetBase):
 
         self._num_s_columns = len(s_1h_col_names)
         self._num_y_columns = len(y_1h_col_names)
+        self._column_names = {
+            "xs": [str(col) for col in all_non_y_non_s_names],
+            "ys": [str(col) for col in y_1h_col_names],
+            "s": [str(col) for col in s_1h_col_names]
+        }
 
         xs = df.iloc[:num_train_examples, all_non_y_non_s_names_indices].values
         ys = df.iloc[:num_train_examples, y_1h_col_names_indices].values
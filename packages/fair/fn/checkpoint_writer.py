@@ -0,0 +1,137 @@
+import os
+import glob
+import logging
+import concurrent.futures
+import tensorflow as tf
+
+
+class CheckpointRetention:
+    """
+    Keeps track of the checkpoints written during training and decides which ones
+    are to be deleted: when keep_last is set, only the last keep_last checkpoints are
+    kept, along with the ones for which must_keep(epoch) is true (and with the final
+    one). When keep_last is None every checkpoint is kept.
+
+    existing is the list of (epoch, path) pairs of the checkpoints written by previous
+    runs (see Options.checkpoint_fnames), sorted by epoch: when training is resumed
+    they are pruned and listed in the checkpoint state file as if written by this run.
+    """
+
+    def __init__(self, keep_last=None, must_keep=None, existing=None):
+        if keep_last != None and keep_last < 1:
+            raise ValueError("at least one checkpoint must be kept (keep_last={})".format(keep_last))
+
+        self.keep_last = keep_last
+        self.must_keep = must_keep if must_keep != None else (lambda epoch: False)
+        self.paths = []
+        self._recent = []
+
+        for epoch, path in existing or []:
+            self._record(os.path.normpath(path), int(epoch) if epoch.isdigit() else epoch)
+
+    def checkpoint_written(self, path, epoch):
+        """
+        records the checkpoint written in path at the given epoch, removes the
+        checkpoints that are no longer to be kept and updates the checkpoint state file
+        (the one read by tf.train.latest_checkpoint) so that it points to path and lists
+        the kept checkpoints. Returns the paths of the removed checkpoints.
+        """
+        removed = self._add(os.path.normpath(path), epoch)
+
+        for removed_path in removed:
+            logging.info("Removing checkpoint: {}".format(removed_path))
+            for fname in glob.glob(removed_path + ".*"):
+                os.remove(fname)
+
+        # update_checkpoint_state modifies the list it is given
+        tf.compat.v1.train.update_checkpoint_state(os.path.dirname(path), path,
+                                                   all_model_checkpoint_paths=list(self.paths))
+
+        return removed
+
+    # PRIVATE METHODS
+
+    def _record(self, path, epoch):
+        # a checkpoint written again (e.g., the final one of a resumed run) replaces the old one
+        self.paths = [p for p in self.paths if p != path] + [path]
+        self._recent = [p for p in self._recent if p != path]
+
+        if epoch != "final" and not self.must_keep(epoch):
+            self._recent.append(path)
+
+    def _add(self, path, epoch):
+        self._record(path, epoch)
+
+        if self.keep_last == None:
+            return []
+
+        removed = self._recent[:-self.keep_last]
+        self._recent = self._recent[len(removed):]
+        self.paths = [p for p in self.paths if p not in removed]
+
+        return removed
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes the checkpoints of the graph based model without blocking training.
+
+    save() copies (on device) the variables into a set of snapshot variables and
+    returns: the snapshot is written to disk by a background thread, using a saver
+    storing each snapshot variable under the name of the original one (checkpoints
+    are thus the same written by saving the model directly). A new snapshot is taken
+    only after the previous one has been written.
+
+    The meta graph does not change during training: it is written only with the
+    first checkpoint (and written again only if that checkpoint gets removed, see
+    CheckpointRetention); the checkpoint state file is updated only once a checkpoint
+    has been completely written, so that it never refers to a partial one.
+    """
+
+    def __init__(self, session, saver, retention=None):
+        self.session = session
+        self.saver = saver
+        self.retention = retention if retention != None else CheckpointRetention()
+
+        variables = tf.compat.v1.global_variables()
+
+        with tf.name_scope("checkpoint_snapshot"):
+            snapshots = [tf.compat.v1.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype),
+                                               trainable=False, collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                               name=var.op.name)
+                         for var in variables]
+
+            self.take_snapshot = tf.group(*[tf.compat.v1.assign(snapshot, var)
+                                            for snapshot, var in zip(snapshots, variables)], name="take_snapshot")
+
+        self.snapshot_saver = tf.compat.v1.train.Saver({var.op.name: snapshot for var, snapshot in zip(variables, snapshots)},
+                                                       max_to_keep=None)
+        self.session.run(tf.compat.v1.variables_initializer(snapshots))
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.meta_graph_path = None
+
+    def save(self, path, epoch):
+        self.wait()
+        self.session.run(self.take_snapshot)
+        self.pending = self.executor.submit(self._write, path, epoch)
+
+    def wait(self):
+        """
+        waits for the checkpoint being written (if any), raising its errors
+        """
+        if self.pending != None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    # PRIVATE METHODS
+
+    def _write(self, path, epoch):
+        path = self.snapshot_saver.save(self.session, path, write_meta_graph=False, write_state=False)
+
+        removed = self.retention.checkpoint_written(path, epoch)
+
+        if self.meta_graph_path == None or self.meta_graph_path in removed:
+            self.saver.export_meta_graph(path + ".meta")
+            self.meta_graph_path = path
@@ -6,66 +6,52 @@ from sklearn.svm import SVC
 from sklearn.linear_model import LogisticRegression
 import logging
 
+from fair.utils.sparse_utils import feed_value
+from fair.fn.checkpoint_writer import AsyncCheckpointWriter, CheckpointRetention
+
 
 class FairNetworksTraining:
+    # number of epochs between two logs of the validation losses
+    LOG_EVERY = 10
+
     def __init__(self, options, session, model, saver, writer):
         self.options = options
         self.dataset = options.dataset
         self.session = session
         self.model = model
+        self.eval_every = getattr(options, 'eval_every', 1)
 
         self.train_xs, self.train_ys, self.train_s = self.dataset.train_all_data()
         self.val_xs, self.val_ys, self.val_s = self.dataset.val_all_data()
 
-        self.train_feed = {model.x: self.train_xs, model.y: self.train_ys, model.s: self.train_s}
-        self.val_feed = {model.x: self.val_xs, model.y: self.val_ys, model.s: self.val_s}
+        self.val_x_value = feed_value(self.val_xs)
 
-        self.train_noise = np.random.uniform(size=self.train_xs.shape)
-        self.val_noise = np.random.uniform(size=self.val_xs.shape)
+        self.val_feed = {model.x: self.val_x_value, model.y: self.val_ys, model.s: self.val_s}
 
-        self.trainset = self.dataset.train_dataset().batch(self.options.batch_size).shuffle(1000)
-        self.trainset_it = self.trainset.make_initializable_iterator()
-        self.trainset_next = self.trainset_it.get_next()
+        self.model.pipeline.initialize(self.session)
+        self.session.run(self.model.reset_train_metrics)
 
         self.saver = saver
+        retention = CheckpointRetention(getattr(options, 'keep_checkpoints', None), getattr(options, 'keep_checkpoint_at_epoch', None),
+                                        getattr(options, 'checkpoint_fnames', list)())
+        self.checkpoint_writer = AsyncCheckpointWriter(self.session, saver, retention)
 
         self.writer = writer
 
         self.s_variables = [var for varlist in self.model.s_variables for var in varlist]
-        self.init_s_vars = tf.variables_initializer(self.s_variables, name="init_s_vars")
+        self.init_s_vars = tf.compat.v1.variables_initializer(self.s_variables, name="init_s_vars")
 
     def run_epoch_batched(self):
-        dataset_size = len(self.train_xs)
-        batch = 0
-        noise_batch_start = 0
-        tot_batches = dataset_size / self.options.batch_size
-        self.session.run(self.trainset_it.initializer)
-
-        epoch = self.session.run(self.model.epoch)
-
-        while True:
-            try:
-                xs, ys, s = self.session.run(self.trainset_next)
-                noise = self.train_noise[noise_batch_start:(noise_batch_start+len(xs))]
-                noise_batch_start += len(xs)
-
-                self.session.run(self.model.s_train_step, feed_dict = { 
-                    self.model.x:xs, 
-                    self.model.s:s, 
-                    self.model.noise:noise })
-                self.session.run(self.model.y_train_step, feed_dict = { 
-                    self.model.x:xs, 
-                    self.model.y:ys,
-                    self.model.noise:noise })
-                self.session.run(self.model.h_train_step, feed_dict = { 
-                    self.model.x:xs, 
-                    self.model.y:ys, 
-                    self.model.s:s, 
-                    self.model.noise:noise })
-
-
-            except tf.errors.OutOfRangeError:
-                break
+        # batches are read by the model directly from the input pipeline; training
+        # stats are accumulated along with the first training step of each batch
+        first_step, *other_steps = self.model.batch_train_steps
+
+        for _ in range(self.model.pipeline.steps_per_epoch):
+            self.session.run(self.model.pipeline.load_batch)
+            self.session.run([first_step, self.model.update_train_metrics])
+
+            for train_step in other_steps:
+                self.session.run(train_step)
 
 
     def training_loop(self):
@@ -76,13 +62,16 @@ class FairNetworksTraining:
             self.run_epoch_batched()
             self.updateTensorboardStats(epoch)
 
-            if epoch % 10 == 0:
-                self.log_losses(epoch)
-                # self.log_stats_classifier(epoch)
-                
-                if self.options.verbose:
-                    self.model.print_weight(self.session, 2)
-                    self.model.print_weight(self.session, 3)
+            if epoch % self.LOG_EVERY == 0 or epoch % self.eval_every == 0:
+                val_measures = self.evaluate_validation(epoch)
+
+                if epoch % self.LOG_EVERY == 0:
+                    self.log_losses(epoch, val_measures)
+                    # self.log_stats_classifier(epoch)
+
+                    if self.options.verbose:
+                        self.model.print_weight(self.session, 2)
+                        self.model.print_weight(self.session, 3)
 
             self.session.run(self.model.inc_epoch)
             epoch = int(self.session.run(self.model.epoch)[0])
@@ -91,40 +80,42 @@ class FairNetworksTraining:
 
         logging.info("Training ended at epoch: {}".format(epoch))
         self.save_model("final")
+        self.checkpoint_writer.wait()
+
+    def evaluate_validation(self, epoch):
+        """
+        Evaluates the model on the validation set (with a single session.run), writes
+        the validation stats and returns the tuple (y loss, s loss, h loss, y accuracy).
+        """
+        stat_des, *measures = self.session.run(
+            [self.model.val_stats, self.model.y_loss, self.model.s_mean_loss, self.model.h_loss, self.model.y_accuracy],
+            feed_dict = { **self.val_feed, **self.model.noise_feed() })
+        self.writer.add_summary(stat_des, global_step = epoch)
 
-    def log_losses(self, epoch):
-        nn_y_loss = self.session.run(self.model.y_loss, feed_dict = {
-            self.model.x: self.val_xs, 
-            self.model.y: self.val_ys,
-            self.model.noise: self.val_noise
-            })
-        nn_s_loss = self.session.run(self.model.s_mean_loss, feed_dict = {
-            self.model.x: self.val_xs, 
-            self.model.s: self.val_s,
-            self.model.noise: self.val_noise
-            })
-        nn_h_loss = self.session.run(self.model.h_loss, feed_dict = {
-            self.model.x: self.val_xs, 
-            self.model.s: self.val_s, 
-            self.model.y: self.val_ys,
-            self.model.noise: self.val_noise})
-
-        nn_y_accuracy = self.session.run(self.model.y_accuracy, feed_dict = {
-            self.model.x: self.val_xs,
-            self.model.y: self.val_ys,
-            self.model.noise: self.val_noise
-            })
-
-        logging.info('Stats on the validation set -- Epoch {:4} y loss: {:07.6f} s loss: {:07.6f} h loss: {:07.6f} y accuracy: {:07.6f}'.format(
-                        epoch, nn_y_loss, nn_s_loss, nn_h_loss, nn_y_accuracy))
+        return measures
+
+    def log_losses(self, epoch, val_measures):
+        if np.ndim(val_measures[0]) > 0:
+            # population model: one line for each network
+            for member, member_measures in enumerate(zip(*val_measures)):
+                logging.info('Network {:3} -- '.format(member) + self._format_losses(epoch, member_measures))
+            return
+
+        logging.info(self._format_losses(epoch, val_measures))
+
+    def _format_losses(self, epoch, val_measures):
+        nn_y_loss, nn_s_loss, nn_h_loss, nn_y_accuracy = val_measures
+
+        return 'Stats on the validation set -- Epoch {:4} y loss: {:07.6f} s loss: {:07.6f} h loss: {:07.6f} y accuracy: {:07.6f}'.format(
+                        epoch, nn_y_loss, nn_s_loss, nn_h_loss, nn_y_accuracy)
 
     def log_stats_classifier(self, epoch, classifier=LogisticRegression):
         train_repr = self.session.run(self.model.model_last_hidden_layer, feed_dict = {
-            self.model.x: self.train_xs, 
-            self.model.noise: self.train_noise})
+            self.model.x: feed_value(self.train_xs),
+            **self.model.noise_feed()})
         val_repr = self.session.run(self.model.model_last_hidden_layer, feed_dict = {
-            self.model.x: self.val_xs, 
-            self.model.noise: self.val_noise})
+            self.model.x: self.val_x_value, 
+            **self.model.noise_feed()})
         
         cl = classifier(solver="sag", max_iter=1000)
         cl.fit(train_repr, np.argmax(self.train_ys, axis=1))
@@ -141,23 +132,14 @@ class FairNetworksTraining:
         return y_val_acc, s_val_acc
 
     def updateTensorboardStats(self, epoch):
-        stat_des = self.session.run(self.model.train_stats, feed_dict = { 
-            self.model.x:self.train_xs, 
-            self.model.y:self.train_ys, 
-            self.model.s: self.train_s,
-            self.model.noise: self.train_noise })
-
-        self.writer.add_summary(stat_des, global_step = epoch)
-
-        stat_des = self.session.run(self.model.val_stats, feed_dict = { 
-            self.model.x:self.val_xs, 
-            self.model.y:self.val_ys, 
-            self.model.s: self.val_s,
-            self.model.noise: self.val_noise })
+        # training stats are the running means accumulated during the epoch
+        stat_des = self.session.run(self.model.train_stats)
         self.writer.add_summary(stat_des, global_step = epoch)
+        self.session.run(self.model.reset_train_metrics)
 
 
     def save_model(self, epoch):
         if epoch == "final" or self.options.save_at_epoch(epoch):
             logging.info("Saving model (epoch:{})".format(epoch))
-            self.saver.save(self.session, self.options.output_fname(epoch))
+            # the checkpoint is written in background (see AsyncCheckpointWriter)
+            self.checkpoint_writer.save(self.options.output_fname(epoch), epoch)
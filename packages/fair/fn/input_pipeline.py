@@ -0,0 +1,120 @@
+import math
+import tensorflow as tf
+
+from fair.utils.sparse_utils import feed_value
+
+
+class InputPipeline:
+    """
+    tf.data pipeline feeding the training batches to the model without moving them
+    back and forth between python and tensorflow.
+
+    The training set is fed (once) to the placeholders used to initialize the
+    iterator; the dataset is then batched, shuffled, repeated and prefetched in a
+    background thread. Since the model performs several training steps (one per
+    session.run) on the same batch, the current batch is buffered into local
+    (i.e., not saved in checkpoints) variables: running load_batch pulls the next
+    batch from the iterator and stores it into the buffer, and the tensors in
+    self.batch read from it.
+
+    When noise is used, each batch comes with the seed (a pair of integers) to be
+    used by the model to generate the noise (on device, using a stateless RNG):
+    batches keep their content across epochs, so that, unless noise_resample is
+    set, the same noise is generated for each example at every epoch. Setting
+    noise_resample draws new noise for every batch at every epoch.
+
+    Attributes:
+        steps_per_epoch: number of batches in an epoch
+        batch: dictionary mapping 'x', 'y', 's' (and 'noise_seed', when noise is used)
+            to the tensors holding the current batch
+        load_batch: op loading the next batch into the buffer
+    """
+
+    SHUFFLE_BUFFER_SIZE = 1000
+
+    def __init__(self, dataset, batch_size, with_noise, noise_seed=0, noise_resample=False):
+        self.dataset = dataset
+        self.with_noise = with_noise
+        self.noise_seed = noise_seed
+        self.noise_resample = noise_resample
+
+        xs, ys, s = dataset.train_all_data()
+        num_features = xs.shape[1]
+        self.steps_per_epoch = int(math.ceil(xs.shape[0] / float(batch_size)))
+
+        with tf.name_scope("input_pipeline"):
+            if dataset.sparse():
+                self.xs_in = tf.compat.v1.sparse_placeholder(tf.float32, shape=[None, num_features], name="xs_in")
+            else:
+                self.xs_in = tf.compat.v1.placeholder(tf.float32, shape=[None, num_features], name="xs_in")
+
+            self.ys_in = tf.compat.v1.placeholder(tf.as_dtype(ys.dtype), shape=[None, ys.shape[1]], name="ys_in")
+            self.s_in = tf.compat.v1.placeholder(tf.as_dtype(s.dtype), shape=[None, s.shape[1]], name="s_in")
+
+            # batches are shuffled (but their content is not), as it has always been done
+            # in FairNetworksTraining
+            data = tf.data.Dataset.from_tensor_slices((self.xs_in, self.ys_in, self.s_in))
+            data = data.batch(batch_size)
+            data = data.map(self._labels_to_float, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+            if with_noise:
+                # batches are numbered before being shuffled: the number identifies
+                # the examples in the batch
+                data = data.enumerate()
+
+            data = data.shuffle(self.SHUFFLE_BUFFER_SIZE).repeat()
+
+            if with_noise:
+                data = data.enumerate().map(self._add_noise_seed, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+            data = data.prefetch(tf.data.experimental.AUTOTUNE)
+
+            self.iterator = tf.compat.v1.data.make_initializable_iterator(data)
+            self.batch, self.load_batch, self.buffer_variables = self._buffer(self.iterator.get_next())
+            self.init_buffer = tf.compat.v1.variables_initializer(self.buffer_variables, name="init_buffer")
+
+    def initialize(self, session):
+        """
+        Feeds the training set to the pipeline. It needs to be called once, before
+        running load_batch.
+        """
+        xs, ys, s = self.dataset.train_all_data()
+        feed_dict = { self.xs_in: feed_value(xs), self.ys_in: ys, self.s_in: s }
+
+        session.run(self.iterator.initializer, feed_dict=feed_dict)
+        session.run(self.init_buffer)
+
+    # PRIVATE METHODS
+
+    def _labels_to_float(self, xs, ys, s):
+        return xs, tf.cast(ys, tf.float32), tf.cast(s, tf.float32)
+
+    def _add_noise_seed(self, step, data):
+        batch_index, (xs, ys, s) = data
+
+        if self.noise_resample:
+            key = step
+        else:
+            key = batch_index
+
+        return xs, ys, s, tf.stack([tf.constant(self.noise_seed, dtype=tf.int64), key])
+
+    def _buffer(self, next_batch):
+        flat_batch = tf.nest.flatten(next_batch, expand_composites=True)
+
+        variables = []
+        for index, tensor in enumerate(flat_batch):
+            empty_shape = [0 if dim is None else dim for dim in tensor.shape.as_list()]
+            variables.append(tf.compat.v1.Variable(tf.zeros(empty_shape, dtype=tensor.dtype),
+                                    trainable=False, validate_shape=False,
+                                    collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                    name="batch_buffer_%d" % index))
+
+        load_batch = tf.group(*[tf.compat.v1.assign(variable, tensor, validate_shape=False)
+                                for variable, tensor in zip(variables, flat_batch)], name="load_batch")
+
+        buffered = tf.nest.pack_sequence_as(next_batch, [variable.read_value() for variable in variables],
+                                            expand_composites=True)
+        names = ['x', 'y', 's', 'noise_seed'] if self.with_noise else ['x', 'y', 's']
+
+        return dict(zip(names, buffered)), load_batch, variables
@@ -0,0 +1,257 @@
+import logging
+import numpy as np
+import scipy.sparse
+import tensorflow as tf
+
+from fair.utils.sparse_utils import to_sparse_tensor
+
+
+class NoiseLayer(tf.keras.layers.Layer):
+    """
+    Keras counterpart of Model._build_layer_noise: combines its input with the given
+    noise (one value per feature) according to noise_type.
+    """
+    def __init__(self, noise_type, initializers, **kwargs):
+        super().__init__(**kwargs)
+        self.noise_type = noise_type
+        self.initializers = initializers
+
+    def build(self, input_shape):
+        num_features = int(input_shape[-1])
+        self.alpha = self.add_weight(name="alpha", shape=[num_features], initializer=self.initializers[0]())
+        self.w_beta = self.add_weight(name="w-beta", shape=[num_features], initializer=self.initializers[1]())
+        super().build(input_shape)
+
+    def call(self, inputs, noise):
+        beta = tf.multiply(noise, self.w_beta)
+
+        if self.noise_type == 'default':
+            return tf.multiply(inputs, self.alpha) + beta
+        elif self.noise_type == 'sigmoid_full':
+            return tf.nn.sigmoid(tf.multiply(inputs, self.alpha) + beta)
+        elif self.noise_type == 'sigmoid_sep':
+            return tf.nn.sigmoid(tf.multiply(inputs, self.alpha)) + tf.nn.sigmoid(beta)
+        elif self.noise_type == 'sigmoid_sep_2':
+            return (tf.nn.sigmoid(tf.multiply(inputs, self.alpha)) + tf.nn.sigmoid(beta)) / 2
+
+
+class KerasModel(tf.keras.Model):
+    """
+    Native TF2 implementation of the fair networks model (see fair.fn.model.Model for
+    the graph based one). The architecture, and the names of the variables, are the
+    same: checkpoints written by the graph based model can be restored with
+    restore_v1_checkpoint.
+
+    The model is called on a pair (x, noise) and returns the tuple (h, s_out, y_out)
+    of the hidden representation and of the s and y logits; x can be a tf.SparseTensor
+    (in which case the first hidden layer must be a plain dense layer).
+    """
+
+    def __init__(self, options):
+        super().__init__(name="fair_networks")
+
+        self.num_features = options.num_features
+        self.num_s_labels = options.dataset.num_s_columns()
+        self.num_y_labels = options.dataset.num_y_columns()
+
+        self.noise_type = options.noise_type
+        self.sparse_input = options.dataset.sparse()
+        self.has_noise_layers = any(layer[0] == 'n' for layer in options.hidden_layers)
+
+        random_seed = getattr(options, 'random_seed', None)
+        self.noise_seed_value = random_seed if random_seed != None else np.random.randint(2**31 - 1)
+
+        self.fairness_importance = tf.Variable(options.fairness_importance, dtype=tf.float32,
+                                               trainable=False, name="fairness_importance")
+        self.epoch = tf.Variable([0.0], trainable=False, name="epoch")
+
+        self.hidden = self._hidden_layers(options.hidden_layers)
+        self.sensible = self._layers("sensible", options.sensible_layers)
+        self.classifier = self._layers("class", options.class_layers)
+
+        self.s_out = tf.keras.layers.Dense(self.num_s_labels, name="s_out",
+                                           kernel_initializer=tf.keras.initializers.TruncatedNormal(stddev=1.0))
+        self.y_out = tf.keras.layers.Dense(self.num_y_labels, name="y_out",
+                                           kernel_initializer=tf.keras.initializers.TruncatedNormal(stddev=1.0))
+
+        self._build_variables()
+
+    def call(self, inputs, training=False):
+        x, noise = inputs
+        h = self.representation(x, noise)
+        return h, self.s_logits(h), self.y_logits(h)
+
+    def representation(self, x, noise=None):
+        """
+        returns the output of the last hidden layer (i.e., the learnt representation of x)
+        """
+        for layer in self.hidden:
+            if isinstance(layer, NoiseLayer):
+                x = layer(x, noise)
+            else:
+                x = layer(x)
+
+        return x
+
+    def s_logits(self, h):
+        for layer in self.sensible:
+            h = layer(h)
+
+        return self.s_out(h)
+
+    def y_logits(self, h):
+        for layer in self.classifier:
+            h = layer(h)
+
+        return self.y_out(h)
+
+    def input_tensor(self, xs):
+        """
+        converts xs (a numpy array or a scipy.sparse matrix) into a model input
+        """
+        if scipy.sparse.issparse(xs):
+            return to_sparse_tensor(xs)
+
+        return tf.convert_to_tensor(xs, dtype=tf.float32)
+
+    def noise_for(self, xs, key=-1):
+        """
+        returns the noise to be given to the model along with xs (None when the model
+        has no noise layers). Noise is generated by a stateless RNG seeded by the pair
+        (random seed, key): the default key is the one used to evaluate the model,
+        see KerasFairNetworksTraining for the ones used during training.
+        """
+        if not self.has_noise_layers:
+            return None
+
+        seed = tf.stack([tf.constant(self.noise_seed_value, dtype=tf.int64), tf.cast(key, tf.int64)])
+        return tf.random.stateless_uniform([tf.shape(xs)[0], self.num_features], seed=seed)
+
+    def hidden_variables(self):
+        return [var for layer in self.hidden for var in layer.trainable_weights]
+
+    def s_variables(self):
+        return [var for layer in self.sensible + [self.s_out] for var in layer.trainable_weights]
+
+    def y_variables(self):
+        return [var for layer in self.classifier + [self.y_out] for var in layer.trainable_weights]
+
+    def v1_variables(self):
+        """
+        returns a dictionary mapping the name each variable has in checkpoints written
+        by fair.fn.model.Model to the variable itself
+        """
+        result = { "fairness_importance": self.fairness_importance, "epoch": self.epoch }
+
+        for layer in self.hidden + self.sensible + self.classifier + [self.s_out, self.y_out]:
+            for var in layer.weights:
+                name = var.name.split(":")[0].split("/")[-1]
+                result["{}/{}".format(layer.name, name)] = var
+
+        return result
+
+    def restore_v1_checkpoint(self, path):
+        """
+        restores the variables of the model from a checkpoint written by the graph based
+        model (i.e., by tf.compat.v1.train.Saver). Optimizer state is not restored.
+        """
+        reader = tf.train.load_checkpoint(path)
+
+        for name, var in self.v1_variables().items():
+            if not reader.has_tensor(name):
+                logging.warning("Variable {} not found in checkpoint {}".format(name, path))
+                continue
+
+            var.assign(np.reshape(reader.get_tensor(name), var.shape))
+
+    def print_loss_and_accuracy(self, train_data, test_data):
+        print('|variable|acc. (train)|acc. (test)|loss (train)| loss(test)|')
+        print('|:------:|-----------:|----------:|-----------:|----------:|')
+
+        train_measures = self._loss_and_accuracy(*train_data)
+        test_measures = self._loss_and_accuracy(*test_data)
+
+        for name in ["y", "s"]:
+            loss_train_val, accuracy_train_val = train_measures[name]
+            loss_test_val, accuracy_test_val = test_measures[name]
+
+            print("|%8s|     %2.5f|    %2.5f|     %2.5f|    %2.5f|" % (
+                name,accuracy_train_val, accuracy_test_val, loss_train_val, loss_test_val))
+
+    def print_confusion_matrix(self, data):
+        xs, ys, _ = data
+        x = self.input_tensor(xs)
+        _, _, y_out = self((x, self.noise_for(x)))
+
+        predicted = np.argmax(y_out.numpy(), 1)
+        actual = np.argmax(ys, 1)
+        tp = np.count_nonzero(predicted * actual)
+        tn = np.count_nonzero((predicted - 1) * (actual - 1))
+        fp = np.count_nonzero(predicted * (actual - 1))
+        fn = np.count_nonzero((predicted - 1) * actual)
+
+        print("|        |predicted +|predicted -|")
+        print("|:------:|----------:|----------:|")
+        print("|actual +|%11d|%11d|" % (tp,fn))
+        print("|actual -|%11d|%11d|" % (fp,tn))
+
+    def print_weights(self):
+        for var in self.trainable_variables:
+            print("var[{}]={}".format(var.name, var.numpy()))
+
+    # PRIVATE METHODS
+
+    def _loss_and_accuracy(self, xs, ys, s):
+        x = self.input_tensor(xs)
+        _, s_out, y_out = self((x, self.noise_for(x)))
+
+        result = {}
+        for name, labels, logits in [("y", ys, y_out), ("s", s, s_out)]:
+            labels = tf.cast(labels, tf.float32)
+            loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits))
+            accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(logits, 1), tf.argmax(labels, 1)), tf.float32))
+            result[name] = (float(loss), float(accuracy))
+
+        return result
+
+    def _dense(self, layer, name):
+        _, num_nodes, activation, initializers = layer
+        return tf.keras.layers.Dense(num_nodes, activation=activation, kernel_initializer=initializers[0](),
+                                     bias_initializer=initializers[1](), name=name)
+
+    def _layers(self, layer_name, layers):
+        return [self._dense(layer, "%s-layer-%d" % (layer_name, index+1))
+                for index, layer in enumerate(layers) if layer[0] != 'i']
+
+    def _hidden_layers(self, hidden_layers):
+        result = []
+        for i, layer in enumerate(hidden_layers):
+            layer_type = layer[0]
+            if i == 0 and self.sparse_input:
+                assert layer_type == None, "the first hidden layer must be a plain dense layer when using sparse inputs"
+
+            # same (1 based) numbering used by Model._build_hidden_layers, where dense
+            # layers are numbered starting from 2
+            if layer_type == 'n':
+                result.append(NoiseLayer(self.noise_type, layer[3], name="noise-layer-%d" % (i+1)))
+            elif layer_type == 'w':
+                result.append(self._dense(layer, "hidden-whiteout-layer-%d" % (i+2)))
+            else:
+                result.append(self._dense(layer, "hidden-layer-%d" % (i+2)))
+
+        return result
+
+    def _build_variables(self):
+        # variables are created upfront so that they can be restored (or assigned)
+        # before the model is called for the first time
+        num_inputs = self.num_features
+        for layer in self.hidden:
+            layer.build(tf.TensorShape([None, num_inputs]))
+            num_inputs = layer.units if isinstance(layer, tf.keras.layers.Dense) else num_inputs
+
+        h_size = num_inputs
+        for layers, out in [(self.sensible, self.s_out), (self.classifier, self.y_out)]:
+            num_inputs = h_size
+            for layer in layers + [out]:
+                layer.build(tf.TensorShape([None, num_inputs]))
+                num_inputs = layer.units
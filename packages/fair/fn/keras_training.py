@@ -0,0 +1,254 @@
+from __future__ import print_function
+import logging
+import tensorflow as tf
+
+from fair.fn.checkpoint_writer import CheckpointRetention
+
+
+class KerasFairNetworksTraining:
+    """
+    Training loop for fair.fn.keras_model.KerasModel: the TF2 counterpart of
+    FairNetworksTraining.
+
+    Each batch is processed by a single tf.function (compiled with XLA unless
+    options.jit_compile is False or the input is sparse) performing the same steps
+    of the graph based model: options.schedule.sub_nets_num_it s and y steps on the
+    hidden representation of the batch followed by the h step. Checkpoints are
+    written by tf.train.Checkpoint using the same file names used by the graph
+    based model, in background when the installed TF supports it (see
+    _supports_async_checkpoints).
+
+    Noise is generated as in the graph based model: batches are numbered (before
+    being shuffled) and the number is used to seed the noise of the batch, unless
+    options.noise_resample is set, in which case a new seed is used at each step.
+
+    Training stats are running means accumulated by the training step (on the
+    hidden representation of each batch, before the classifiers are updated), while
+    the validation set is evaluated every options.eval_every epochs.
+    """
+
+    SHUFFLE_BUFFER_SIZE = 1000
+
+    # number of epochs between two logs of the validation losses
+    LOG_EVERY = 10
+
+    STATS = ["y_loss", "y_accuracy", "s_loss", "s_accuracy", "h_loss"]
+
+    def __init__(self, options, model, optimizer, writer):
+        self.options = options
+        self.dataset = options.dataset
+        self.model = model
+        self.optimizer = optimizer
+        self.writer = writer
+        self.eval_every = getattr(options, 'eval_every', 1)
+
+        schedule = getattr(options, 'schedule', None)
+        self.classifiers_iterations = schedule.sub_nets_num_it if schedule != None else 1
+
+        self.val_data = self._tensors(self.dataset.val_all_data())
+
+        if hasattr(optimizer, "build"):
+            # newer optimizers need to know in advance all the variables they will update
+            optimizer.build(model.trainable_variables)
+
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+        self.async_checkpoints = self._supports_async_checkpoints()
+        self.retention = CheckpointRetention(getattr(options, 'keep_checkpoints', None),
+                                             getattr(options, 'keep_checkpoint_at_epoch', None),
+                                             getattr(options, 'checkpoint_fnames', list)())
+        self.train_metrics = { name: tf.keras.metrics.Mean(name="train_" + name) for name in self.STATS }
+
+        jit_compile = getattr(options, 'jit_compile', True) and not model.sparse_input
+        self.train_step = tf.function(self._train_step, jit_compile=jit_compile)
+        self.evaluate = tf.function(self._evaluate)
+
+        self.noise_resample = getattr(options, 'noise_resample', False)
+        self.steps = 0
+
+        self.train_batches = self._train_batches()
+
+    def run_epoch_batched(self):
+        for batch_index, (xs, ys, s) in self.train_batches:
+            noise_key = tf.constant(self.steps, dtype=tf.int64) if self.noise_resample else batch_index
+            self.train_step(xs, ys, s, noise_key)
+            self.steps += 1
+
+    def training_loop(self):
+        epoch = int(self.model.epoch.numpy()[0])
+        logging.info("Starting training loop from epoch: {}".format(epoch))
+
+        while epoch < self.options.schedule.num_epochs:
+            self.run_epoch_batched()
+            self.updateTensorboardStats(epoch)
+
+            if epoch % self.LOG_EVERY == 0 or epoch % self.eval_every == 0:
+                stats = self.evaluate_validation(epoch)
+
+                if epoch % self.LOG_EVERY == 0:
+                    self.log_losses(epoch, stats)
+
+                    if self.options.verbose:
+                        self.model.print_weights()
+
+            self.model.epoch.assign_add([1.0])
+            epoch = int(self.model.epoch.numpy()[0])
+            self.save_model(epoch)
+
+        logging.info("Training ended at epoch: {}".format(epoch))
+        self.save_model("final")
+        if self.async_checkpoints:
+            self.checkpoint.sync()
+
+    def evaluate_validation(self, epoch):
+        """
+        Evaluates the model on the validation set, writes the validation stats and
+        returns them.
+        """
+        stats = self.evaluate(*self.val_data, self.model.noise_for(self.val_data[0]))
+        self._write_stats("val", stats, epoch)
+
+        return stats
+
+    def log_losses(self, epoch, stats):
+        logging.info('Stats on the validation set -- Epoch {:4} y loss: {:07.6f} s loss: {:07.6f} h loss: {:07.6f} y accuracy: {:07.6f}'.format(
+                        epoch, stats["y_loss"], stats["s_loss"], stats["h_loss"], stats["y_accuracy"]))
+
+    def updateTensorboardStats(self, epoch):
+        # training stats are the running means accumulated during the epoch
+        self._write_stats("train", { name: metric.result() for name, metric in self.train_metrics.items() }, epoch)
+
+        for metric in self.train_metrics.values():
+            metric.reset_state()
+
+    def save_model(self, epoch):
+        if epoch == "final" or self.options.save_at_epoch(epoch):
+            logging.info("Saving model (epoch:{})".format(epoch))
+
+            if not self.async_checkpoints:
+                path = self.checkpoint.write(self.options.output_fname(epoch))
+                self.retention.checkpoint_written(path, epoch)
+                return
+
+            # the checkpoint is written in background; once it has been written, old
+            # checkpoints are removed and the state read by tf.train.latest_checkpoint
+            # (used to resume training) is updated
+            options = tf.train.CheckpointOptions(enable_async=True,
+                                                 experimental_write_callbacks=[lambda path: self.retention.checkpoint_written(path, epoch)])
+            self.checkpoint.write(self.options.output_fname(epoch), options=options)
+
+    def restore(self, path):
+        """
+        restores the model (and, for TF2 checkpoints, the optimizer) from the given
+        checkpoint; checkpoints written by the graph based model are supported too.
+        """
+        if tf.train.load_checkpoint(path).has_tensor("_CHECKPOINTABLE_OBJECT_GRAPH"):
+            self.checkpoint.read(path).expect_partial()
+        else:
+            self.model.restore_v1_checkpoint(path)
+
+    # PRIVATE METHODS
+
+    def _supports_async_checkpoints(self):
+        """
+        true if the installed TF can write checkpoints in background, calling back
+        once they are written (TF 2.5, the pinned version, cannot)
+        """
+        if not hasattr(self.checkpoint, "sync"):
+            return False
+
+        try:
+            tf.train.CheckpointOptions(enable_async=True, experimental_write_callbacks=[])
+        except TypeError:
+            return False
+
+        return True
+
+    def _train_batches(self):
+        data = self.dataset.train_dataset().batch(self.options.batch_size)
+        data = data.map(self._labels_to_float, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return data.enumerate().shuffle(self.SHUFFLE_BUFFER_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def _write_stats(self, split, stats, epoch):
+        with self.writer.as_default():
+            tf.summary.scalar("y_loss/y_{}_softmax_loss".format(split), stats["y_loss"], step=epoch)
+            tf.summary.scalar("y_accuracy/y_{}_accuracy".format(split), stats["y_accuracy"], step=epoch)
+            tf.summary.scalar("s_loss/s_{}_softmax_loss".format(split), stats["s_loss"], step=epoch)
+            tf.summary.scalar("s_accuracy/s_{}_accuracy".format(split), stats["s_accuracy"], step=epoch)
+            tf.summary.scalar("h_loss/h_{}_loss".format(split), stats["h_loss"], step=epoch)
+
+        self.writer.flush()
+
+    def _tensors(self, data):
+        xs, ys, s = data
+        return self.model.input_tensor(xs), tf.cast(ys, tf.float32), tf.cast(s, tf.float32)
+
+    def _labels_to_float(self, xs, ys, s):
+        return xs, tf.cast(ys, tf.float32), tf.cast(s, tf.float32)
+
+    def _loss(self, labels, logits):
+        return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits))
+
+    def _accuracy(self, labels, logits):
+        return tf.reduce_mean(tf.cast(tf.equal(tf.argmax(logits, 1), tf.argmax(labels, 1)), tf.float32))
+
+    def _classifiers_step(self, h, ys, s):
+        s_variables = self.model.s_variables()
+        with tf.GradientTape() as tape:
+            s_loss = self._loss(s, self.model.s_logits(h))
+        self.optimizer.apply_gradients(zip(tape.gradient(s_loss, s_variables), s_variables))
+
+        y_variables = self.model.y_variables()
+        with tf.GradientTape() as tape:
+            y_loss = self._loss(ys, self.model.y_logits(h))
+        self.optimizer.apply_gradients(zip(tape.gradient(y_loss, y_variables), y_variables))
+
+    def _train_step(self, xs, ys, s, noise_key):
+        hidden_variables = self.model.hidden_variables()
+
+        with tf.GradientTape(persistent=True) as tape:
+            h = self.model.representation(xs, self.model.noise_for(xs, noise_key))
+
+            with tape.stop_recording():
+                self._update_train_metrics(h, ys, s)
+
+            # the hidden layers are not modified by the classifiers steps: their
+            # output is computed only once
+            with tape.stop_recording():
+                # the first iteration is outside of the loop since optimizers may create
+                # their variables the first time they are used
+                self._classifiers_step(h, ys, s)
+                for _ in tf.range(self.classifiers_iterations - 1):
+                    self._classifiers_step(h, ys, s)
+
+            y_loss = self._loss(ys, self.model.y_logits(h))
+            s_loss = self._loss(s, self.model.s_logits(h))
+
+        h_grads_s = [-self.model.fairness_importance * grad for grad in tape.gradient(s_loss, hidden_variables)]
+        h_grads_y = tape.gradient(y_loss, hidden_variables)
+        del tape
+
+        self.optimizer.apply_gradients(zip(h_grads_s, hidden_variables))
+        self.optimizer.apply_gradients(zip(h_grads_y, hidden_variables))
+
+    def _update_train_metrics(self, h, ys, s):
+        batch_size = tf.cast(tf.shape(ys)[0], tf.float32)
+        stats = self._stats(ys, s, self.model.s_logits(h), self.model.y_logits(h))
+
+        for name, metric in self.train_metrics.items():
+            metric.update_state(stats[name], sample_weight=batch_size)
+
+    def _evaluate(self, xs, ys, s, noise):
+        _, s_out, y_out = self.model((xs, noise))
+        return self._stats(ys, s, s_out, y_out)
+
+    def _stats(self, ys, s, s_out, y_out):
+        y_loss = self._loss(ys, y_out)
+        s_loss = self._loss(s, s_out)
+
+        return {
+            "y_loss": y_loss,
+            "s_loss": s_loss,
+            "h_loss": y_loss - self.model.fairness_importance * s_loss,
+            "y_accuracy": self._accuracy(ys, y_out),
+            "s_accuracy": self._accuracy(s, s_out)
+        }
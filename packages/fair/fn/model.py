@@ -3,6 +3,7 @@ import numpy as np
 import time
 import sys
 from fair.utils.loss_utils import estimate_mean_and_variance
+from fair.fn.input_pipeline import InputPipeline
 
 
 class Model:
@@ -22,6 +23,18 @@ class Model:
             print("|%8s|     %2.5f|    %2.5f|     %2.5f|    %2.5f|" % (
                 name,accuracy_train_val, accuracy_test_val, loss_train_val, loss_test_val))
 
+    def noise_feed(self, key=-1):
+        """
+        returns the feed_dict entries needed to generate the noise when the model is
+        not reading its inputs from the input pipeline; the noise is seeded by the pair
+        (random seed, key), so that evaluations are repeatable (keys used during
+        training are non negative).
+        """
+        if not self.has_noise_layers:
+            return {}
+
+        return { self.noise_seed: [self.noise_seed_value, key] }
+
     def print_confusion_matrix(self, session, feed_dict):
         (tp,tn,fp,fn) = session.run(self.confusion_matrix, feed_dict = feed_dict)
 
@@ -63,11 +76,14 @@ class Model:
 
     def _build(self, options, optimizer):
         num_features = options.num_features
+        self.num_features = num_features
         num_s_labels = options.dataset.num_s_columns()
 
         num_y_labels = options.dataset.num_y_columns()
 
         self.noise_type = options.noise_type
+        self.sparse_input = options.dataset.sparse()
+        self.has_noise_layers = any(layer[0] == 'n' for layer in options.hidden_layers)
 
         self.fairness_importance = tf.Variable(
             options.fairness_importance, name="fairness_importance")
@@ -76,10 +92,34 @@ class Model:
             "epoch", shape=[1], initializer=tf.zeros_initializer)
         self.inc_epoch = self.epoch.assign(self.epoch + 1)
 
-        self.x     = tf.compat.v1.placeholder(tf.float32, shape=[None, num_features], name="x")
-        self.noise = tf.compat.v1.placeholder(tf.float32, shape=[None, num_features], name="noise")
-        self.y     = tf.compat.v1.placeholder(tf.float32, shape=[None, num_y_labels], name="y")
-        self.s     = tf.compat.v1.placeholder(tf.float32, shape=[None, num_s_labels], name="s")
+        # the model reads its inputs from the training pipeline unless they are fed
+        # explicitly (e.g., when evaluating the model on the validation set)
+        self.noise_seed_value = self._noise_seed_value(options)
+        self.pipeline = InputPipeline(options.dataset, options.batch_size, self.has_noise_layers,
+                                      noise_seed=self.noise_seed_value,
+                                      noise_resample=getattr(options, 'noise_resample', False))
+        batch = self.pipeline.batch
+
+        if self.sparse_input:
+            self.x = self._sparse_input_with_default(batch['x'], name="x")
+        else:
+            self.x = tf.compat.v1.placeholder_with_default(batch['x'], shape=[None, num_features], name="x")
+
+        if self.has_noise_layers:
+            # noise is generated on device by a stateless RNG seeded by the input pipeline
+            # (see noise_feed for evaluating the model on other data)
+            self.noise_seed = tf.compat.v1.placeholder_with_default(batch['noise_seed'], shape=[2], name="noise_seed")
+            noise = tf.random.stateless_uniform(tf.stack([self._num_rows(self.x), num_features]), seed=self.noise_seed)
+            self.noise = tf.compat.v1.placeholder_with_default(noise, shape=[None, num_features], name="noise")
+        else:
+            self.noise_seed = None
+            self.noise = tf.compat.v1.placeholder(tf.float32, shape=[None, num_features], name="noise")
+
+        self.y     = tf.compat.v1.placeholder_with_default(batch['y'], shape=[None, num_y_labels], name="y")
+        self.s     = tf.compat.v1.placeholder_with_default(batch['s'], shape=[None, num_s_labels], name="s")
+
+        # training stats are running means over the training batches (see _train_mean)
+        self._train_metrics_updates = []
 
         self.h_random_mean, self.h_random_var = estimate_mean_and_variance(num_features)
 
@@ -102,45 +142,45 @@ class Model:
         with tf.name_scope("y_loss"):
             self.y_loss = tf.reduce_mean(
                 tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.y, logits=self.y_out))
-            self.y_train_loss_stat = tf.summary.scalar("y_train_softmax_loss", self.y_loss)
-            self.y_val_loss_stat = tf.summary.scalar("y_val_softmax_loss", self.y_loss)
+            self.y_train_loss_stat = tf.compat.v1.summary.scalar("y_train_softmax_loss", self._train_mean(self.y_loss))
+            self.y_val_loss_stat = tf.compat.v1.summary.scalar("y_val_softmax_loss", self.y_loss)
 
         with tf.name_scope("s_loss"):
             mean_kld, var_kld = tf.nn.moments(
                 tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.s, logits=self.s_out), 0)
             self.s_var_loss = var_kld
             self.s_mean_loss = mean_kld
-            self.s_train_loss_stat = tf.summary.scalar("s_train_softmax_loss", self.s_mean_loss)
-            self.s_val_loss_stat = tf.summary.scalar("s_val_softmax_loss", self.s_mean_loss)
+            self.s_train_loss_stat = tf.compat.v1.summary.scalar("s_train_softmax_loss", self._train_mean(self.s_mean_loss))
+            self.s_val_loss_stat = tf.compat.v1.summary.scalar("s_val_softmax_loss", self.s_mean_loss)
 
         with tf.name_scope("h_loss"):
             #self.h_loss = self.y_loss + self.fairness_importance * (tf.math.pow(self.s_mean_loss - self.h_random_mean, 2)
                                                                  #+  tf.math.pow(self.s_var_loss - self.h_random_var, 2))
             self.h_loss = self.y_loss - \
                 (self.fairness_importance * self.s_mean_loss)
-            self.h_train_loss_stat = tf.summary.scalar("h_train_loss", self.h_loss)
-            self.h_val_loss_stat = tf.summary.scalar("h_val_loss", self.h_loss)
+            self.h_train_loss_stat = tf.compat.v1.summary.scalar("h_train_loss", self._train_mean(self.h_loss))
+            self.h_val_loss_stat = tf.compat.v1.summary.scalar("h_val_loss", self.h_loss)
 
         with tf.name_scope("y_accuracy"):
             y_correct_predictions = tf.cast(
                 tf.equal(tf.argmax(self.y_out, 1), tf.argmax(self.y, 1)), "float")
             self.y_accuracy = tf.cast(
                 tf.reduce_mean(y_correct_predictions), "float")
-            self.y_train_accuracy_stat = tf.summary.scalar("y_train_accuracy", self.y_accuracy)
-            self.y_val_accuracy_stat = tf.summary.scalar("y_val_accuracy", self.y_accuracy)
+            self.y_train_accuracy_stat = tf.compat.v1.summary.scalar("y_train_accuracy", self._train_mean(self.y_accuracy))
+            self.y_val_accuracy_stat = tf.compat.v1.summary.scalar("y_val_accuracy", self.y_accuracy)
 
         with tf.name_scope("s_accuracy"):
             s_correct_predictions = tf.cast(
                 tf.equal(tf.argmax(self.s_out, 1), tf.argmax(self.s, 1)), "float")
             self.s_accuracy = tf.cast(tf.reduce_mean(s_correct_predictions), "float")
-            self.s_train_accuracy_stat = tf.summary.scalar("s_train_accuracy", self.s_accuracy)
-            self.s_val_accuracy_stat = tf.summary.scalar("s_val_accuracy", self.s_accuracy)
+            self.s_train_accuracy_stat = tf.compat.v1.summary.scalar("s_train_accuracy", self._train_mean(self.s_accuracy))
+            self.s_val_accuracy_stat = tf.compat.v1.summary.scalar("s_val_accuracy", self.s_accuracy)
 
         with tf.name_scope("svc_accuracies"):
             self.s_svc_accuracy = tf.compat.v1.placeholder(tf.float32)
             self.y_svc_accuracy = tf.compat.v1.placeholder(tf.float32)
-            self.s_svc_accuracy_stat = tf.summary.scalar("s_svc_accuracy", self.s_svc_accuracy)
-            self.y_svc_accuracy_stat = tf.summary.scalar("y_svc_accuracy", self.y_svc_accuracy)
+            self.s_svc_accuracy_stat = tf.compat.v1.summary.scalar("s_svc_accuracy", self.s_svc_accuracy)
+            self.y_svc_accuracy_stat = tf.compat.v1.summary.scalar("y_svc_accuracy", self.y_svc_accuracy)
 
         with tf.name_scope("y_confusion_matrix"):
             predicted = tf.argmax(self.y_out, 1)
@@ -158,6 +198,17 @@ class Model:
 
         self.h_train_step, self.y_train_step, self.s_train_step = self._create_train_steps(optimizer)
 
+        # the schedule ('cN') specifies how many classifiers (s and y) training steps are
+        # performed on each batch before training the hidden layers
+        schedule = getattr(options, 'schedule', None)
+        self.classifiers_iterations = schedule.sub_nets_num_it if schedule != None else 1
+        self.train_step_mode = getattr(options, 'train_step', 'separate')
+        self.batch_train_steps = self._create_batch_train_steps(optimizer, h_layer, options)
+
+        self.update_train_metrics = tf.group(*self._train_metrics_updates, name="update_train_metrics")
+        self.reset_train_metrics = tf.compat.v1.variables_initializer(
+            tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.METRIC_VARIABLES, r".*/train_metrics/"), name="reset_train_metrics")
+
         self.train_stats = tf.compat.v1.summary.merge([self.y_train_loss_stat, self.y_train_accuracy_stat, self.s_train_loss_stat,
                                              self.s_train_accuracy_stat, self.h_train_loss_stat])
         self.val_stats = tf.compat.v1.summary.merge([self.y_val_loss_stat, self.y_val_accuracy_stat, self.s_val_loss_stat,
@@ -165,6 +216,45 @@ class Model:
 
         return self
 
+    def _train_mean(self, value):
+        """
+        returns the running mean of value (weighted by the number of examples) over
+        the batches on which update_train_metrics has been run since the last time
+        reset_train_metrics has been run.
+        """
+        num_rows = tf.cast(self._num_rows(self.x), tf.float32)
+
+        with tf.compat.v1.variable_scope("train_metrics"):
+            mean, update = tf.compat.v1.metrics.mean(value, weights=num_rows)
+
+        self._train_metrics_updates.append(update)
+        return mean
+
+    def _noise_seed_value(self, options):
+        random_seed = getattr(options, 'random_seed', None)
+        if random_seed == None:
+            return np.random.randint(2**31 - 1)
+
+        return random_seed
+
+    def _num_rows(self, x):
+        if self.sparse_input:
+            return x.dense_shape[0]
+
+        return tf.shape(x, out_type=tf.int64)[0]
+
+    def _sparse_input_with_default(self, default, name):
+        """
+        sparse counterpart of tf.compat.v1.placeholder_with_default: each component of
+        the returned SparseTensor can be fed (e.g., feeding a SparseTensorValue)
+        """
+        with tf.name_scope(name):
+            indices = tf.compat.v1.placeholder_with_default(default.indices, shape=[None, 2], name="indices")
+            values = tf.compat.v1.placeholder_with_default(default.values, shape=[None], name="values")
+            dense_shape = tf.compat.v1.placeholder_with_default(default.dense_shape, shape=[2], name="shape")
+
+        return tf.SparseTensor(indices=indices, values=values, dense_shape=dense_shape)
+
     def _build_layers(self, in_layer, layer_name, layers):
         variables = []
 
@@ -182,7 +272,10 @@ class Model:
         hidden_variables = []
         for i, layer in enumerate(hidden_layers):
             layer_type = layer[0]
-            if layer_type == 'n':
+            if i == 0 and self.sparse_input:
+                assert layer_type == None, "the first hidden layer must be a plain dense layer when using sparse inputs"
+                in_layer, variables = self._build_sparse_layer(in_layer, "hidden", layer, i+1)
+            elif layer_type == 'n':
                 initializer = layer[3]
                 in_layer, variables = self._build_layer_noise(in_layer, initializer, i+1)
             elif layer_type == 'w':
@@ -221,6 +314,29 @@ class Model:
 
         return in_layer, layer_variables
 
+    def _build_sparse_layer(self, in_layer, layer_name, layer, index):
+        """
+        Same as _build_layer, but in_layer is a tf.SparseTensor. Variables are named
+        as the ones created by _build_layer.
+        """
+        _, num_nodes, activation, initializers = layer
+        num_inputs = self.num_features
+
+        with tf.name_scope("%s-layer-%d" % (layer_name, index+1)):
+            with tf.compat.v1.variable_scope("%s-layer-%d" % (layer_name, index+1)):
+                w = tf.compat.v1.get_variable("kernel", dtype=tf.float32,
+                                shape=[num_inputs, num_nodes],
+                                initializer=initializers[0]())
+                b = tf.compat.v1.get_variable("bias", dtype=tf.float32,
+                                shape=[num_nodes],
+                                initializer=initializers[1]())
+
+            out = tf.sparse.sparse_dense_matmul(in_layer, w) + b
+            if activation != None:
+                out = activation(out)
+
+        return out, [w, b]
+
     def _build_layer_noise(self, in_layer, initializer, index):
         variables = []
 
@@ -266,13 +382,17 @@ class Model:
 
         return in_layer, layer_variables
 
-    def _create_train_steps(self, optimizer):
+    def _hidden_gradients(self, optimizer, y_loss, s_loss):
         h_grads_vars_s = optimizer.compute_gradients(
-            self.s_mean_loss, var_list=self.hidden_layers_variables)
+            s_loss, var_list=self.hidden_layers_variables)
         h_grads_vars_s = [(self.fairness_importance * -gv[0], gv[1])
                           for gv in h_grads_vars_s]
         h_grads_vars_y = optimizer.compute_gradients(
-            self.y_loss, var_list=self.hidden_layers_variables)
+            y_loss, var_list=self.hidden_layers_variables)
+        return h_grads_vars_s, h_grads_vars_y
+
+    def _create_train_steps(self, optimizer):
+        h_grads_vars_s, h_grads_vars_y = self._hidden_gradients(optimizer, self.y_loss, self.s_mean_loss)
         y_grads = optimizer.compute_gradients(
             self.y_loss, var_list=self.y_variables)
         s_grads = optimizer.compute_gradients(
@@ -280,7 +400,142 @@ class Model:
         h_s_step = optimizer.apply_gradients(h_grads_vars_s)
         h_y_step = optimizer.apply_gradients(h_grads_vars_y)
         self.h_grads = h_grads_vars_s + h_grads_vars_y
+        self.y_grads = y_grads
+        self.s_grads = s_grads
         h_train_step = tf.group(h_s_step, h_y_step)
         y_train_step = optimizer.apply_gradients(y_grads)
         s_train_step = optimizer.apply_gradients(s_grads)
         return h_train_step, y_train_step, s_train_step
+
+    def _create_batch_train_steps(self, optimizer, h_layer, options):
+        """
+        Returns the list of ops to be run (in order, one session.run each) on every
+        batch according to self.train_step_mode and self.classifiers_iterations.
+        """
+        if self.train_step_mode == 'simultaneous':
+            # the last classifiers iteration is performed by the simultaneous step
+            steps = [self._create_simultaneous_train_step(optimizer)]
+            if self.classifiers_iterations > 1:
+                steps.insert(0, self._create_classifiers_train_step(
+                    optimizer, h_layer, options, self.classifiers_iterations - 1))
+            return steps
+
+        if self.train_step_mode == 'fused':
+            classifiers_step = self._create_classifiers_train_step(
+                optimizer, h_layer, options, self.classifiers_iterations)
+            return [self._create_fused_train_step(optimizer, h_layer, options, classifiers_step)]
+
+        if self.classifiers_iterations > 1:
+            classifiers_step = self._create_classifiers_train_step(
+                optimizer, h_layer, options, self.classifiers_iterations)
+            return [classifiers_step, self.h_train_step]
+
+        return [self.s_train_step, self.y_train_step, self.h_train_step]
+
+    def _apply_layers(self, in_layer, layers, variables, out_activation=None):
+        """
+        Recomputes (reading the current value of the given variables) the output of
+        layers built by _build_layers followed by an output layer.
+        """
+        variables = list(variables)
+        activations = [layer[2] for layer in layers if layer[0] != 'i'] + [out_activation]
+
+        for activation in activations:
+            w, b = variables.pop(0), variables.pop(0)
+            in_layer = tf.matmul(in_layer, w.read_value()) + b.read_value()
+            if activation != None:
+                in_layer = activation(in_layer)
+
+        return in_layer
+
+    def _create_fused_train_step(self, optimizer, h_layer, options, classifiers_step):
+        """
+        Returns a single op performing the s, y and h training steps with the same
+        semantics of running s_train_step, y_train_step and h_train_step one after the
+        other. The hidden representation of the batch is computed only once: the s and
+        y steps do not modify the hidden layers, hence the h step needs to recompute
+        only the s and y heads (reading the updated variables) on top of it.
+
+        classifiers_step is the op performing the s and y steps (see
+        _create_classifiers_train_step).
+        """
+        with tf.name_scope("fused_train_step"):
+            with tf.control_dependencies([classifiers_step]):
+                s_out = self._apply_layers(h_layer, options.sensible_layers, self._flat(self.s_variables))
+                y_out = self._apply_layers(h_layer, options.class_layers, self._flat(self.y_variables))
+
+                y_loss = tf.reduce_mean(
+                    tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.y, logits=y_out))
+                s_loss = tf.reduce_mean(
+                    tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.s, logits=s_out))
+
+                h_grads_vars_s, h_grads_vars_y = self._hidden_gradients(optimizer, y_loss, s_loss)
+                h_s_step = optimizer.apply_gradients(h_grads_vars_s)
+                with tf.control_dependencies([h_s_step]):
+                    h_y_step = optimizer.apply_gradients(h_grads_vars_y)
+
+            return h_y_step
+
+    def _create_classifiers_train_step(self, optimizer, h_layer, options, num_iterations):
+        """
+        Returns an op performing num_iterations s and y training steps on the current
+        batch. The first iteration uses the gradients computed on the forward pass of
+        the batch (hence, when run along with the step, update_train_metrics sees the
+        variables before any update); the remaining ones run in a tf.while_loop: the
+        hidden representation is computed once (hidden layers are not modified by these
+        steps) and only the s and y heads are recomputed at each iteration.
+        """
+        with tf.name_scope("classifiers_train_step"):
+            # y gradients do not depend on the s variables, but the optimizer state
+            # (e.g., Adam's beta powers) is shared: steps are applied in order
+            with tf.control_dependencies([self.s_train_step]):
+                first_step = optimizer.apply_gradients(self.y_grads)
+
+        if num_iterations == 1:
+            return first_step
+
+        s_variables = self._flat(self.s_variables)
+        y_variables = self._flat(self.y_variables)
+
+        def body(iteration):
+            s_out = self._apply_layers(h_layer, options.sensible_layers, s_variables)
+            s_loss = tf.reduce_mean(
+                tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.s, logits=s_out))
+            s_step = optimizer.minimize(s_loss, var_list=s_variables)
+
+            with tf.control_dependencies([s_step]):
+                y_out = self._apply_layers(h_layer, options.class_layers, y_variables)
+                y_loss = tf.reduce_mean(
+                    tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(labels=self.y, logits=y_out))
+                y_step = optimizer.minimize(y_loss, var_list=y_variables)
+
+            with tf.control_dependencies([y_step]):
+                return iteration + 1
+
+        with tf.name_scope("classifiers_train_step"):
+            with tf.control_dependencies([first_step]):
+                loop = tf.while_loop(lambda iteration: iteration < num_iterations - 1,
+                                     body, [tf.constant(0)])
+            return tf.group(loop)
+
+    def _create_simultaneous_train_step(self, optimizer):
+        """
+        Returns a single op computing the s, y and h gradients on the same forward pass
+        (i.e., using the variables values before any update) and then applying all of them.
+        """
+        with tf.name_scope("simultaneous_train_step"):
+            grads_and_vars = self.s_grads + self.y_grads + self.h_grads
+            grads = [grad for grad, _ in grads_and_vars if grad is not None]
+
+            # gradients are all computed before applying any of them; applications
+            # are then serialized since they share the optimizer state
+            num_hidden = len(self.hidden_layers_variables)
+            step = tf.group(*grads)
+            for grads_and_vars in [self.s_grads, self.y_grads, self.h_grads[:num_hidden], self.h_grads[num_hidden:]]:
+                with tf.control_dependencies([step]):
+                    step = optimizer.apply_gradients(grads_and_vars)
+
+            return step
+
+    def _flat(self, variables_lists):
+        return [var for varlist in variables_lists for var in varlist]
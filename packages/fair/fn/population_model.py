@@ -0,0 +1,399 @@
+import tensorflow as tf
+
+from fair.fn.input_pipeline import InputPipeline
+
+
+class PopulationModel:
+    """
+    Graph based model training a population of K independent copies of the network
+    of fair.fn.model.Model on the same batches. The weights of each layer are stacked
+    into a single [K, ...] variable, so that the copies are computed by batched
+    matmuls: for the small networks of a grid search this replaces K processes (each
+    one bottlenecked on the per-op overhead) with a single one using wider ops.
+
+    Each copy has its own fairness importance and its own random seed
+    (options.population is the list of their (fairness importance, random seed)
+    pairs), used for its noise layers and for drawing its initial weights: the
+    initial weights of a copy do not depend on the other copies in the population
+    (they are not, however, the ones drawn by Model with the same seed). Since the copies
+    share no variable, minimizing the sum of their losses trains each of them on its
+    own loss (Adam updates are elementwise).
+
+    The attributes used by FairNetworksTraining (losses, accuracies, train steps,
+    stats, ...) have the same names as in Model, but losses and accuracies are
+    vectors with one value per copy and representations have shape [K, N, units].
+    Sparse inputs and the 'fused' and 'simultaneous' train steps are not supported.
+    """
+
+    def __init__(self, options, optimizer):
+        self._build(options, optimizer)
+
+    def print_loss_and_accuracy(self, session, train_feed_dict, test_feed_dict):
+        measures = [["y", [self.y_loss, self.y_accuracy]], ["s", [self.s_mean_loss, self.s_accuracy]]]
+
+        print('|member|variable|acc. (train)|acc. (test)|loss (train)| loss(test)|')
+        print('|-----:|:------:|-----------:|----------:|-----------:|----------:|')
+
+        for name, loss_and_accuracy in measures:
+            loss_train_val, accuracy_train_val = session.run(loss_and_accuracy, feed_dict = train_feed_dict)
+            loss_test_val, accuracy_test_val = session.run(loss_and_accuracy, feed_dict = test_feed_dict)
+
+            for member in range(self.population_size):
+                print("|%6d|%8s|     %2.5f|    %2.5f|     %2.5f|    %2.5f|" % (
+                    member, name, accuracy_train_val[member], accuracy_test_val[member],
+                    loss_train_val[member], loss_test_val[member]))
+
+    def noise_feed(self, key=-1):
+        """
+        same as Model.noise_feed: copy k generates its noise from the pair (seed of
+        copy k, key)
+        """
+        if not self.has_noise_layers:
+            return {}
+
+        return { self.noise_seed: [self.noise_seed_value, key] }
+
+    def print_confusion_matrix(self, session, feed_dict):
+        (tp,tn,fp,fn) = session.run(self.confusion_matrix, feed_dict = feed_dict)
+
+        print("|member|        |predicted +|predicted -|")
+        print("|-----:|:------:|----------:|----------:|")
+        for member in range(self.population_size):
+            print("|%6d|actual +|%11d|%11d|" % (member, tp[member], fn[member]))
+            print("|%6d|actual -|%11d|%11d|" % (member, fp[member], tn[member]))
+
+    def print_weight(self, session, index, variables=None):
+        if variables == None:
+            variables = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.TRAINABLE_VARIABLES)
+
+        var = variables[index]
+        var_value = session.run(var)
+        print("var[{}]={}".format(var.name, var_value))
+
+    def print_weights(self, session):
+        variables = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.TRAINABLE_VARIABLES)
+        for index in range(len(variables)):
+            self.print_weight(session, index, variables)
+
+    # PRIVATE METHODS
+
+    def _build(self, options, optimizer):
+        assert not options.dataset.sparse(), "population training does not support sparse inputs"
+        assert getattr(options, 'train_step', 'separate') == 'separate', "population training supports only the 'separate' train step"
+
+        num_features = options.num_features
+        self.num_features = num_features
+        num_s_labels = options.dataset.num_s_columns()
+        num_y_labels = options.dataset.num_y_columns()
+
+        self.population_size = len(options.population)
+        fairness_importances = [float(fairness) for fairness, _ in options.population]
+        self.member_seeds = [int(seed) for _, seed in options.population]
+
+        self.noise_type = options.noise_type
+        self.sparse_input = False
+        self.has_noise_layers = any(layer[0] == 'n' for layer in options.hidden_layers)
+
+        self.fairness_importance = tf.Variable(fairness_importances, dtype=tf.float32, name="fairness_importance")
+
+        self.epoch = tf.compat.v1.get_variable(
+            "epoch", shape=[1], initializer=tf.zeros_initializer)
+        self.inc_epoch = self.epoch.assign(self.epoch + 1)
+
+        # the pipeline numbers the batches: the seed it gives is replaced by the one of
+        # each copy (see _noise)
+        self.noise_seed_value = self.member_seeds[0]
+        self.pipeline = InputPipeline(options.dataset, options.batch_size, self.has_noise_layers,
+                                      noise_seed=self.noise_seed_value,
+                                      noise_resample=getattr(options, 'noise_resample', False))
+        batch = self.pipeline.batch
+
+        self.x = tf.compat.v1.placeholder_with_default(batch['x'], shape=[None, num_features], name="x")
+
+        if self.has_noise_layers:
+            self.noise_seed = tf.compat.v1.placeholder_with_default(batch['noise_seed'], shape=[2], name="noise_seed")
+            self.noise = tf.compat.v1.placeholder_with_default(self._noise(num_features), shape=[self.population_size, None, num_features],
+                                                               name="noise")
+        else:
+            self.noise_seed = None
+            self.noise = None
+
+        self.y     = tf.compat.v1.placeholder_with_default(batch['y'], shape=[None, num_y_labels], name="y")
+        self.s     = tf.compat.v1.placeholder_with_default(batch['s'], shape=[None, num_s_labels], name="s")
+
+        self._train_metrics_updates = []
+        # variables of the running means of the training stats (see _train_mean)
+        self._train_metrics_variables = []
+        # number of stacked variables built so far, used to seed their initializers
+        self._num_stacked_variables = 0
+
+        h_layer, self.hidden_layers_variables = self._build_hidden_layers(self.x, options.hidden_layers)
+        self.sensible_layers_variables = self._build_layers("sensible", options.sensible_layers, options.hidden_layers[-1][1])
+        self.class_layers_variables = self._build_layers("class", options.class_layers, options.hidden_layers[-1][1])
+        s_out_variables = self._build_out_layer("s_out", options.sensible_layers, options.hidden_layers[-1][1], num_s_labels)
+        y_out_variables = self._build_out_layer("y_out", options.class_layers, options.hidden_layers[-1][1], num_y_labels)
+
+        self.model_last_hidden_layer = h_layer
+        self.y_variables = [self.class_layers_variables, y_out_variables]
+        self.s_variables = [self.sensible_layers_variables, s_out_variables]
+
+        self.s_out = self._apply_layers(h_layer, options.sensible_layers, self._flat(self.s_variables))
+        self.y_out = self._apply_layers(h_layer, options.class_layers, self._flat(self.y_variables))
+
+        with tf.name_scope("y_loss"):
+            self.y_loss = self._cross_entropies(self.y, self.y_out, mean=True)
+
+        with tf.name_scope("s_loss"):
+            self.s_mean_loss, self.s_var_loss = tf.nn.moments(self._cross_entropies(self.s, self.s_out), [1])
+
+        with tf.name_scope("h_loss"):
+            self.h_loss = self.y_loss - self.fairness_importance * self.s_mean_loss
+
+        with tf.name_scope("y_accuracy"):
+            self.y_accuracy = self._accuracies(self.y, self.y_out)
+
+        with tf.name_scope("s_accuracy"):
+            self.s_accuracy = self._accuracies(self.s, self.s_out)
+
+        with tf.name_scope("y_confusion_matrix"):
+            predicted = tf.argmax(self.y_out, 2)
+            actual = tf.argmax(self.y, 1)
+            TP = tf.compat.v1.count_nonzero(predicted * actual, axis=1)
+            TN = tf.compat.v1.count_nonzero((predicted - 1) * (actual - 1), axis=1)
+            FP = tf.compat.v1.count_nonzero(predicted * (actual - 1), axis=1)
+            FN = tf.compat.v1.count_nonzero((predicted - 1) * actual, axis=1)
+            self.confusion_matrix = (TP, TN, FP, FN)
+
+        self.h_train_step, self.y_train_step, self.s_train_step = self._create_train_steps(optimizer)
+
+        schedule = getattr(options, 'schedule', None)
+        self.classifiers_iterations = schedule.sub_nets_num_it if schedule != None else 1
+        self.train_step_mode = 'separate'
+        self.batch_train_steps = self._create_batch_train_steps(optimizer, h_layer, options)
+
+        self._build_stats()
+
+        self.update_train_metrics = tf.group(*self._train_metrics_updates, name="update_train_metrics")
+        self.reset_train_metrics = tf.compat.v1.variables_initializer(self._train_metrics_variables, name="reset_train_metrics")
+
+        return self
+
+    def _noise(self, num_features):
+        """ noise of each copy, generated from the pair (seed of the copy, key of the batch) """
+        shape = tf.stack([tf.shape(self.x, out_type=tf.int64)[0], num_features])
+        key = self.noise_seed[1]
+
+        return tf.stack([tf.random.stateless_uniform(shape, seed=tf.stack([tf.constant(seed, dtype=tf.int64), key]))
+                         for seed in self.member_seeds])
+
+    def _train_mean(self, value):
+        """
+        same as Model._train_mean, value being a vector with one value per copy (the
+        running mean is computed elementwise)
+        """
+        num_rows = tf.cast(tf.shape(self.x)[0], tf.float32)
+        metric_variables = set(tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.METRIC_VARIABLES))
+
+        with tf.compat.v1.variable_scope("train_metrics"):
+            mean, update = tf.compat.v1.metrics.mean_tensor(value, weights=num_rows * tf.ones_like(value))
+
+        self._train_metrics_variables.extend(variable for variable in tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.METRIC_VARIABLES)
+                                             if variable not in metric_variables)
+        self._train_metrics_updates.append(update)
+        return mean
+
+    def _build_stats(self):
+        measures = [("y_softmax_loss", self.y_loss), ("y_accuracy", self.y_accuracy),
+                    ("s_softmax_loss", self.s_mean_loss), ("s_accuracy", self.s_accuracy), ("h_loss", self.h_loss)]
+
+        train_stats = []
+        val_stats = []
+        for name, value in measures:
+            variable, measure = name.split("_", 1)
+            with tf.name_scope(name):
+                train_mean = self._train_mean(value)
+            for member in range(self.population_size):
+                with tf.name_scope("member_%d" % member):
+                    train_stats.append(tf.compat.v1.summary.scalar("%s_train_%s" % (variable, measure), train_mean[member]))
+                    val_stats.append(tf.compat.v1.summary.scalar("%s_val_%s" % (variable, measure), value[member]))
+
+        self.train_stats = tf.compat.v1.summary.merge(train_stats)
+        self.val_stats = tf.compat.v1.summary.merge(val_stats)
+
+    def _member_initializer(self, initializer_class, member, index):
+        """
+        the initializer of copy member for the index-th stacked variable, seeded from
+        the seed of the copy (initializers taking no seed, e.g. zeros, are returned as is)
+        """
+        seed = (self.member_seeds[member] * 10007 + index) % (2 ** 31 - 1)
+        try:
+            return initializer_class(seed=seed)
+        except TypeError:
+            return initializer_class()
+
+    def _stacked_variable(self, name, shape, initializer_class):
+        """ a [K] + shape variable, each copy being initialized from its own seed """
+        index = self._num_stacked_variables
+        self._num_stacked_variables += 1
+
+        initializers = [self._member_initializer(initializer_class, member, index) for member in range(self.population_size)]
+        initial_value = lambda: tf.stack([initializer(shape=shape, dtype=tf.float32) for initializer in initializers])
+        return tf.compat.v1.Variable(initial_value, dtype=tf.float32, name=name)
+
+    def _dense_variables(self, layer_name, num_inputs, num_nodes, initializers):
+        with tf.compat.v1.variable_scope(layer_name):
+            w = self._stacked_variable("kernel", [num_inputs, num_nodes], initializers[0])
+            b = self._stacked_variable("bias", [num_nodes], initializers[1])
+
+        return [w, b]
+
+    def _build_hidden_layers(self, in_layer, hidden_layers):
+        hidden_variables = []
+        num_inputs = self.num_features
+
+        for i, layer in enumerate(hidden_layers):
+            layer_type, num_nodes, activation, initializers = layer
+            if layer_type == 'n':
+                with tf.compat.v1.variable_scope("noise-layer-%d" % (i+1)):
+                    alpha = self._stacked_variable("alpha", [num_inputs], initializers[0])
+                    w_beta = self._stacked_variable("w-beta", [num_inputs], initializers[1])
+                in_layer = self._noise_layer(in_layer, alpha, w_beta)
+                hidden_variables.extend([alpha, w_beta])
+            else:
+                # whiteout layers are plain dense layers in Model too
+                name = "hidden-whiteout" if layer_type == 'w' else "hidden"
+                w, b = self._dense_variables("%s-layer-%d" % (name, i+2), num_inputs, num_nodes, initializers)
+                in_layer = self._dense(in_layer, w, b, activation)
+                hidden_variables.extend([w, b])
+                num_inputs = num_nodes
+
+        return in_layer, hidden_variables
+
+    def _build_layers(self, layer_name, layers, num_inputs):
+        variables = []
+
+        for index, layer in enumerate(layers):
+            if layer[0] == 'i':
+                continue
+
+            _, num_nodes, _, initializers = layer
+            variables.extend(self._dense_variables("%s-layer-%d" % (layer_name, index+1), num_inputs, num_nodes, initializers))
+            num_inputs = num_nodes
+
+        return variables
+
+    def _build_out_layer(self, name, layers, num_inputs, num_labels):
+        num_units = [layer[1] for layer in layers if layer[0] != 'i']
+        num_inputs = num_units[-1] if len(num_units) > 0 else num_inputs
+        initializers = (tf.compat.v1.truncated_normal_initializer, tf.compat.v1.zeros_initializer)
+
+        return self._dense_variables(name, num_inputs, num_labels, initializers)
+
+    def _dense(self, in_layer, w, b, activation):
+        if in_layer.shape.ndims == 2:
+            # the input is shared by all the copies
+            out = tf.einsum('nf,kfo->kno', in_layer, w)
+        else:
+            out = tf.matmul(in_layer, w)
+
+        out = out + tf.expand_dims(b, 1)
+        if activation != None:
+            out = activation(out)
+
+        return out
+
+    def _noise_layer(self, in_layer, alpha, w_beta):
+        alpha = tf.expand_dims(alpha, 1)
+        beta = tf.multiply(self.noise, tf.expand_dims(w_beta, 1))
+
+        if self.noise_type == 'default':
+            return tf.multiply(in_layer, alpha) + beta
+        elif self.noise_type == 'sigmoid_full':
+            return tf.nn.sigmoid(tf.multiply(in_layer, alpha) + beta)
+        elif self.noise_type == 'sigmoid_sep':
+            return tf.nn.sigmoid(tf.multiply(in_layer, alpha)) + tf.nn.sigmoid(beta)
+        elif self.noise_type == 'sigmoid_sep_2':
+            return (tf.nn.sigmoid(tf.multiply(in_layer, alpha)) + tf.nn.sigmoid(beta)) / 2
+
+    def _apply_layers(self, in_layer, layers, variables):
+        """
+        Computes (reading the current value of the given variables) the output of
+        layers built by _build_layers followed by their (linear) output layer.
+        """
+        variables = list(variables)
+        activations = [layer[2] for layer in layers if layer[0] != 'i'] + [None]
+
+        for activation in activations:
+            w, b = variables.pop(0), variables.pop(0)
+            in_layer = self._dense(in_layer, w.read_value(), b.read_value(), activation)
+
+        return in_layer
+
+    def _cross_entropies(self, labels, logits, mean=False):
+        """ [K, N] cross entropies of the logits of each copy ([K] means if mean is true) """
+        entropies = tf.compat.v1.nn.softmax_cross_entropy_with_logits_v2(
+            labels=tf.broadcast_to(labels, tf.shape(logits)), logits=logits)
+
+        return tf.reduce_mean(entropies, 1) if mean else entropies
+
+    def _accuracies(self, labels, logits):
+        correct_predictions = tf.cast(tf.equal(tf.argmax(logits, 2), tf.expand_dims(tf.argmax(labels, 1), 0)), "float")
+        return tf.reduce_mean(correct_predictions, 1)
+
+    def _hidden_gradients(self, optimizer, y_loss, s_loss):
+        # the s gradients of each copy are scaled by its own fairness importance
+        h_grads_vars_s = optimizer.compute_gradients(
+            tf.reduce_sum(s_loss), var_list=self.hidden_layers_variables)
+        h_grads_vars_s = [(-gv[0] * tf.reshape(self.fairness_importance, [-1] + [1] * (gv[1].shape.ndims - 1)), gv[1])
+                          for gv in h_grads_vars_s]
+        h_grads_vars_y = optimizer.compute_gradients(
+            tf.reduce_sum(y_loss), var_list=self.hidden_layers_variables)
+        return h_grads_vars_s, h_grads_vars_y
+
+    def _create_train_steps(self, optimizer):
+        h_grads_vars_s, h_grads_vars_y = self._hidden_gradients(optimizer, self.y_loss, self.s_mean_loss)
+        self.y_grads = optimizer.compute_gradients(
+            tf.reduce_sum(self.y_loss), var_list=self._flat(self.y_variables))
+        self.s_grads = optimizer.compute_gradients(
+            tf.reduce_sum(self.s_mean_loss), var_list=self._flat(self.s_variables))
+        h_train_step = tf.group(optimizer.apply_gradients(h_grads_vars_s), optimizer.apply_gradients(h_grads_vars_y))
+        y_train_step = optimizer.apply_gradients(self.y_grads)
+        s_train_step = optimizer.apply_gradients(self.s_grads)
+        return h_train_step, y_train_step, s_train_step
+
+    def _create_batch_train_steps(self, optimizer, h_layer, options):
+        if self.classifiers_iterations > 1:
+            classifiers_step = self._create_classifiers_train_step(
+                optimizer, h_layer, options, self.classifiers_iterations)
+            return [classifiers_step, self.h_train_step]
+
+        return [self.s_train_step, self.y_train_step, self.h_train_step]
+
+    def _create_classifiers_train_step(self, optimizer, h_layer, options, num_iterations):
+        """ same as Model._create_classifiers_train_step, for all the copies at once """
+        with tf.name_scope("classifiers_train_step"):
+            with tf.control_dependencies([self.s_train_step]):
+                first_step = optimizer.apply_gradients(self.y_grads)
+
+        s_variables = self._flat(self.s_variables)
+        y_variables = self._flat(self.y_variables)
+
+        def body(iteration):
+            s_out = self._apply_layers(h_layer, options.sensible_layers, s_variables)
+            s_step = optimizer.minimize(tf.reduce_sum(self._cross_entropies(self.s, s_out, mean=True)), var_list=s_variables)
+
+            with tf.control_dependencies([s_step]):
+                y_out = self._apply_layers(h_layer, options.class_layers, y_variables)
+                y_step = optimizer.minimize(tf.reduce_sum(self._cross_entropies(self.y, y_out, mean=True)), var_list=y_variables)
+
+            with tf.control_dependencies([y_step]):
+                return iteration + 1
+
+        with tf.name_scope("classifiers_train_step"):
+            with tf.control_dependencies([first_step]):
+                loop = tf.while_loop(lambda iteration: iteration < num_iterations - 1,
+                                     body, [tf.constant(0)])
+            return tf.group(loop)
+
+    def _flat(self, variables_lists):
+        return [var for varlist in variables_lists for var in varlist]
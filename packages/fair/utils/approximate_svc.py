@@ -0,0 +1,50 @@
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.pipeline import make_pipeline
+from sklearn.svm import LinearSVC
+
+
+class ApproximateSVC(BaseEstimator, ClassifierMixin):
+    """
+    Approximation of an RBF kernel SVC (sklearn.svm.SVC) whose training time grows
+    linearly with the number of examples: examples are mapped into an explicit
+    feature space approximating the RBF kernel, where a linear SVM is trained.
+
+    Parameters:
+        kernel_approximation: 'nystroem' (Nystroem method, using n_components training
+            examples as landmarks) or 'rff' (random Fourier features)
+        gamma: RBF kernel coefficient; 'auto' uses 1 / n_features, as SVC(gamma='auto')
+        n_components: dimension of the approximated feature space
+        C: regularization parameter of the linear SVM
+        random_state: seed used to sample the landmarks (or the random features)
+    """
+
+    KERNEL_APPROXIMATIONS = ["nystroem", "rff"]
+
+    def __init__(self, kernel_approximation="nystroem", gamma="auto", n_components=500, C=1.0, random_state=None):
+        self.kernel_approximation = kernel_approximation
+        self.gamma = gamma
+        self.n_components = n_components
+        self.C = C
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        gamma = 1.0 / X.shape[1] if self.gamma == "auto" else self.gamma
+
+        if self.kernel_approximation == "nystroem":
+            # there cannot be more landmarks than examples
+            feature_map = Nystroem(kernel="rbf", gamma=gamma, n_components=min(self.n_components, X.shape[0]),
+                                   random_state=self.random_state)
+        elif self.kernel_approximation == "rff":
+            feature_map = RBFSampler(gamma=gamma, n_components=self.n_components, random_state=self.random_state)
+        else:
+            raise ValueError("unknown kernel approximation: {}".format(self.kernel_approximation))
+
+        self.pipeline_ = make_pipeline(feature_map, LinearSVC(C=self.C, random_state=self.random_state))
+        self.pipeline_.fit(X, y)
+        self.classes_ = self.pipeline_.classes_
+
+        return self
+
+    def predict(self, X):
+        return self.pipeline_.predict(X)
@@ -0,0 +1,78 @@
+import os
+import json
+import hashlib
+import tempfile
+
+# representations whose performances do not depend on the trained model: they are
+# the same for every experiment (and epoch) on the same dataset
+BASELINES = ['random_networks_repr', 'original_repr']
+
+
+class BaselineCache:
+    """
+    On-disk cache of the performances (as written by test_representations) of the
+    baseline representations, shared by all the experiments on the same dataset.
+
+    Entries are json files keyed on the hash of the dataset cache key (which covers
+    the data files, the preprocessing and the split seed, see DatasetCache.key), the
+    name and width of the representation and the parameters of the classifiers and
+    MI estimators evaluated on it, so that changing any of them produces a new key.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def for_dataset(dataset):
+        """ returns the cache stored next to the dataset cache (see DatasetCache.cache_dir) """
+        return BaselineCache(os.path.join(dataset.workingdir, "cache", "baselines"))
+
+    def key(self, dataset_key, representation, width, classifiers, mi_estimators):
+        """
+        returns the key of the performances of the given baseline representation;
+        classifiers is a list of (name, class, constructor arguments) tuples, as
+        returned by test_representations.classifiers
+        """
+        specs = {
+            "version": self.VERSION,
+            "dataset": dataset_key,
+            "representation": representation,
+            "width": width,
+            # the number of jobs does not change the results (all seeds are fixed)
+            "classifiers": [[name, klass.__name__, {arg: value for arg, value in kargs.items() if arg != "n_jobs"}]
+                            for name, klass, kargs in classifiers],
+            "mi_estimators": sorted(mi_estimators)
+        }
+        digest = hashlib.sha1(json.dumps(specs, sort_keys=True).encode("utf8"))
+
+        return "{}-{}".format(representation, digest.hexdigest())
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """ returns the cached performances with the given key, None if there are none """
+        return load_entry(self.entry_path(key))
+
+    def put(self, key, performances):
+        """
+        stores the given performances; the entry is written into a temporary file and
+        then moved into place, so that concurrent processes never read partial entries
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=self.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(performances, f)
+
+        os.replace(tmp_path, self.entry_path(key))
+        return self.entry_path(key)
+
+def load_entry(path):
+    """ returns the performances stored in the given cache entry, None if it does not exist """
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,112 @@
+import os
+import re
+import glob
+import json
+
+# variables read from checkpoints, as named by the graph based model (fair.fn.model)
+CHECKPOINT_VARIABLES = ['epoch', 'fairness_importance']
+
+
+def _variable_keys(reader, name):
+    """
+    returns the keys under which the given variable may be stored: checkpoints
+    written by the TF2 model (tf.train.Checkpoint) store it as an attribute of the
+    model object.
+    """
+    return [key for key in reader.get_variable_to_shape_map().keys()
+            if key == name or key == 'model/{}/.ATTRIBUTES/VARIABLE_VALUE'.format(name)]
+
+def checkpoint_info(path):
+    """
+    reads the epoch and the fairness importance stored in the given checkpoint
+    (without building the model) and returns them in a dictionary; the fairness
+    importance is a list for checkpoints written by a population model.
+    """
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(path)
+
+    result = {}
+    for name in CHECKPOINT_VARIABLES:
+        keys = _variable_keys(reader, name)
+        if len(keys) == 0:
+            result[name] = None
+            continue
+
+        value = reader.get_tensor(keys[0])
+        if name == 'epoch':
+            result[name] = int(value.reshape(-1)[0])
+        else:
+            result[name] = float(value) if value.ndim == 0 else value.tolist()
+
+    return result
+
+def model_dir_for(config_path):
+    """ returns the model directory of the experiment with the given config file (see Options.model_dir) """
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+
+    return os.path.join(os.path.dirname(config_path), config.get('model_dir', 'models/'))
+
+def experiment_checkpoint(config_path):
+    """
+    returns the checkpoint restored by fair_networks for the experiment with the
+    given config file (see Options.input_fname): the resume_ckpt option, if set, or
+    the latest checkpoint in the model directory
+    """
+    with open(config_path, 'r') as f:
+        resume_ckpt = json.load(f).get('resume_ckpt', None)
+
+    if resume_ckpt:
+        return resume_ckpt
+
+    return latest_checkpoint(model_dir_for(config_path))
+
+def checkpoint_paths(model_dir):
+    """
+    returns the list of pairs (epoch suffix, path) of the checkpoints in model_dir,
+    sorted by epoch (the final checkpoint, if any, comes last)
+    """
+    result = []
+    for index_path in glob.glob(os.path.join(model_dir, 'model-*.ckpt.index')):
+        path = index_path[:-len('.index')]
+        epoch = os.path.basename(path)[len('model-'):-len('.ckpt')]
+        result.append((epoch, path))
+
+    return sorted(result, key=lambda item: (not item[0].isdigit(), int(item[0]) if item[0].isdigit() else item[0]))
+
+# line of the checkpoint state file (the one written by tf.train.update_checkpoint_state)
+# giving the path of the latest checkpoint
+STATE_PATH_REGEXP = r'^model_checkpoint_path:\s*"((?:[^"\\]|\\.)*)"\s*$'
+
+def latest_checkpoint(model_dir):
+    """
+    same as tf.train.latest_checkpoint, without importing TF: returns the path of the
+    latest checkpoint listed in the state file of model_dir, None if there is no
+    state file or the checkpoint does not exist.
+    """
+    state_path = os.path.join(model_dir, 'checkpoint')
+    if not os.path.isfile(state_path):
+        return None
+
+    with open(state_path, 'r') as f:
+        matches = [re.match(STATE_PATH_REGEXP, line.strip()) for line in f]
+    matches = [match for match in matches if match != None]
+    if len(matches) == 0:
+        return None
+
+    path = re.sub(r'\\(.)', r'\1', matches[0].group(1))
+    if not os.path.isabs(path):
+        path = os.path.join(model_dir, path)
+
+    # V2 checkpoints are identified by their index file, V1 ones by their path
+    if os.path.isfile(path + '.index') or len(glob.glob(path)) > 0:
+        return path
+
+    return None
+
+def list_checkpoints(model_dir):
+    """
+    returns, for each checkpoint in model_dir, the tuple (epoch suffix, path, info),
+    where info is the dictionary returned by checkpoint_info
+    """
+    return [(epoch, path, checkpoint_info(path)) for epoch, path in checkpoint_paths(model_dir)]
@@ -0,0 +1,35 @@
+import importlib
+
+
+class LazyAttribute:
+    """
+    Callable standing for an attribute of a module (e.g., LazyAttribute('tensorflow',
+    'nn.sigmoid')), which is imported only the first time the callable is called.
+    It allows tables of TF functions (activations, initializers) to be built without
+    paying for importing TF in tools which never use them.
+    """
+
+    def __init__(self, module_name, path):
+        self.module_name = module_name
+        self.path = path
+        self._value = None
+
+    def resolve(self):
+        if self._value is None:
+            value = importlib.import_module(self.module_name)
+            for name in self.path.split("."):
+                value = getattr(value, name)
+            self._value = value
+
+        return self._value
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        return "LazyAttribute({}.{})".format(self.module_name, self.path)
+
+def import_class(qualified_name):
+    """ imports and returns the class with the given qualified name (e.g., 'package.module.Class') """
+    module_name, class_name = qualified_name.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
@@ -1,29 +1,17 @@
 import sys
-from fair.datasets.bank_marketing_dataset import BankMarketingDataset
-from fair.datasets.adult_dataset import AdultDataset
-from fair.datasets.synth_dataset import SynthDataset
-from fair.datasets.german_dataset import GermanDataset
-from fair.datasets.german_louizos_dataset import GermanLouizosDataset
-from fair.datasets.synth_easy_dataset import SynthEasyDataset
-from fair.datasets.synth_easy2_dataset import SynthEasy2Dataset
-from fair.datasets.synth_easy3_dataset import SynthEasy3Dataset
-from fair.datasets.synth_easy4_dataset import SynthEasy4Dataset
-from fair.datasets.yale_b_dataset import YaleBDataset
-from fair.datasets.compas_dataset import CompasDataset
-from fair.datasets.default_dataset import DefaultDataset
-from fair.datasets.fake_news_dataset import FakeNewsDataset
 import argparse
 import textwrap
 import os
 import json
 import re
-import tensorflow as tf
 from copy import copy, deepcopy
 from termcolor import colored
 from pathlib import Path
-import glob
 import logging
 
+from fair.utils.lazy_import import LazyAttribute, import_class
+from fair.utils.checkpoints import latest_checkpoint, checkpoint_paths
+
 PARAMS_DESCRIPTION = """\
 or:
 
@@ -55,7 +43,7 @@ the integer after the 'c' option specifies how much the sensible and y layer hav
 at each iteration.
 
 example:
-    m100:c100        -- train the whole network for 10 epochs; for each batch train
+    m100:c100        -- train the whole network for 100 epochs; for each batch train
                         the sensible and y network for 100 iterations before using it to
                         feedback the prediction to train model
 
@@ -92,7 +80,7 @@ class Schedule:
         schedule_specs: string array containing the components of the schedule as specified
             in the options.
         num_epochs: number of epochs to be performed following this schedule
-        sub_nets_num_it: numbe of epochs for training the s and y subworks
+        sub_nets_num_it: number of training iterations of the s and y subnetworks on each batch
     """
     def __init__(self, schedule_str):
         self.schedule_specs = schedule_str.split(':')
@@ -129,6 +117,9 @@ class Options:
         self.dataset_base_path: directory where dataset are stored
         self.dataset: an object instantiated to a subclass of DatasetBase allowing
             working with the given dataset
+        self.use_dataset_cache: false if the preprocessed dataset should not be read from (nor
+            written to) the on-disk dataset cache
+        self.streaming_load: true if the dataset should be read (and encoded) in chunks
 
         self.num_features: number of features for the input data (depends on the dataset chosen)
         self.checkpoint_output: path name where to store checkpoints
@@ -141,39 +132,78 @@ class Options:
             contained in each hidden layer
         self.noise_type: string specifying which kind of activation to be used after the 
             noise layer. Defaults to 'default', which uses no activation.
+        self.noise_resample: true if new noise has to be drawn at each epoch (by default the
+            noise given to each example is the same at every epoch)
 
         if result.schedule: array containing the schedule for the training of the network
 
         self.eval_stats: true if the task is simply to evaluate stats and exit
         self.eval_data_path: string representing the path where to store the representations built
             by the current model (if != None no training is performed)
+        self.eval_batch_size: number of examples processed at once when computing representations
+            (None to process each split at once)
+        self.representation_format: format of the files where representations are stored ('npz',
+            the default, or 'csv'; see fair.utils.representations)
+        self.export_all_checkpoints: true if the representations built by every checkpoint in the
+            model directory have to be stored (see checkpoint_fnames), each one with its own suffix
         self.fairness_importance: numeric value representing how important the fairness constraint is
+        self.train_step: how the s, y and h training steps are performed on each batch (one of
+            'separate', 'fused', 'simultaneous')
+        self.eval_every: number of epochs between two evaluations of the model on the validation set
+        self.tf2: true if the native TF2 implementation (fair.fn.keras_model) has to be used
+            instead of the graph based one
+        self.jit_compile: false if the TF2 training step should not be compiled with XLA
+        self.population: list of (fairness importance, random seed) pairs, one for each copy of the
+            network trained together by fair.fn.population_model.PopulationModel; None (the default)
+            to train a single network
 
         self.epochs_per_save: number of epochs to be performed before saving a new model. This is
             used only epochs > 1000. Before this treshold a model is saved every 10 epochs.
+        self.keep_checkpoints: number of checkpoints to be kept (besides the final one and the
+            ones saved at the end points of the save schedule), None to keep all of them
     """
 
+    EVAL_BATCH_SIZE = 65536
+
     HIDDEN_LAYER_SPEC_REGEXP = r'^([wnslrieh])?(\d+)?$'
 
-    INITIALIZERS = {
-        'constant': tf.initializers.constant,
-        'glorot_normal': tf.initializers.glorot_uniform,
-        'glorot_uniform': tf.initializers.glorot_uniform,
-        'identity': tf.initializers.identity,
-        'ones': tf.initializers.ones,
-        'orthogonal': tf.initializers.orthogonal,
-        'random_normal': tf.initializers.RandomNormal,
-        'random_uniform': tf.initializers.RandomUniform,
-        'truncated_normal': tf.initializers.TruncatedNormal,
-        'variance_scaling': tf.initializers.VarianceScaling,
-        'zeros': tf.initializers.zeros
+    # TF (and the dataset modules) are imported only when actually used: tools which
+    # just read the options do not pay for it
+    INITIALIZERS = {name: LazyAttribute('tensorflow', 'initializers.' + initializer) for name, initializer in [
+        ('constant', 'constant'),
+        ('glorot_normal', 'glorot_uniform'),
+        ('glorot_uniform', 'glorot_uniform'),
+        ('identity', 'identity'),
+        ('ones', 'ones'),
+        ('orthogonal', 'orthogonal'),
+        ('random_normal', 'RandomNormal'),
+        ('random_uniform', 'RandomUniform'),
+        ('truncated_normal', 'TruncatedNormal'),
+        ('variance_scaling', 'VarianceScaling'),
+        ('zeros', 'zeros')
+    ]}
+
+    ACTIVATIONS = {
+        'sigmoid': LazyAttribute('tensorflow', 'nn.sigmoid'),
+        'relu': LazyAttribute('tensorflow', 'nn.relu'),
+        'leaky_relu': LazyAttribute('tensorflow', 'nn.leaky_relu'),
+        'tanh': LazyAttribute('tensorflow', 'nn.tanh'),
+        'identity': LazyAttribute('tensorflow', 'identity')
     }
 
-    DATASETS = {'adult': AdultDataset, 'bank': BankMarketingDataset,
-                'german': GermanDataset, 'german-louizos': GermanLouizosDataset, 'synth': SynthDataset,
-                'synth-easy': SynthEasyDataset, 'synth-easy2': SynthEasy2Dataset, 'synth-easy3': SynthEasy3Dataset,
-                'yale': YaleBDataset, 'synth-easy4': SynthEasy4Dataset, 'compas': CompasDataset,
-                'default': DefaultDataset, 'fakenews': FakeNewsDataset}
+    DATASETS = {'adult': 'fair.datasets.adult_dataset.AdultDataset',
+                'bank': 'fair.datasets.bank_marketing_dataset.BankMarketingDataset',
+                'german': 'fair.datasets.german_dataset.GermanDataset',
+                'german-louizos': 'fair.datasets.german_louizos_dataset.GermanLouizosDataset',
+                'synth': 'fair.datasets.synth_dataset.SynthDataset',
+                'synth-easy': 'fair.datasets.synth_easy_dataset.SynthEasyDataset',
+                'synth-easy2': 'fair.datasets.synth_easy2_dataset.SynthEasy2Dataset',
+                'synth-easy3': 'fair.datasets.synth_easy3_dataset.SynthEasy3Dataset',
+                'yale': 'fair.datasets.yale_b_dataset.YaleBDataset',
+                'synth-easy4': 'fair.datasets.synth_easy4_dataset.SynthEasy4Dataset',
+                'compas': 'fair.datasets.compas_dataset.CompasDataset',
+                'default': 'fair.datasets.default_dataset.DefaultDataset',
+                'fakenews': 'fair.datasets.fake_news_dataset.FakeNewsDataset'}
 
 
     def __init__(self, args):
@@ -209,6 +239,13 @@ class Options:
         self.resume_learning = self.input_fname() != None
 
         self.batch_size = result.batch_size
+        self.train_step = getattr(result, 'train_step', None) or 'separate'
+        self.eval_every = getattr(result, 'eval_every', None) or 1
+        self.keep_checkpoints = getattr(result, 'keep_checkpoints', None)
+        if self.keep_checkpoints != None and self.keep_checkpoints < 1:
+            raise ParseError("--keep-checkpoints must be at least 1 (found {})".format(self.keep_checkpoints))
+        self.tf2 = getattr(result, 'tf2', False)
+        self.jit_compile = not getattr(result, 'no_jit_compile', False)
         self.learning_rate = result.learning_rate
 
         if result.schedule != None:
@@ -216,7 +253,18 @@ class Options:
 
         self.eval_stats = result.eval_stats
         self.eval_data_path = self.path_for(result.eval_data)
+        self.representation_format = getattr(result, 'representation_format', None) or 'npz'
+        self.eval_batch_size = getattr(result, 'eval_batch_size', None)
+        if self.eval_batch_size == None:
+            self.eval_batch_size = self.EVAL_BATCH_SIZE
+        elif self.eval_batch_size <= 0:
+            self.eval_batch_size = None
+        self.export_all_checkpoints = getattr(result, 'export_all_checkpoints', False)
+
+        if self.export_all_checkpoints and self.eval_data_path == None:
+            raise ParseError("--export-all-checkpoints requires the path of the representations (-E)")
         self.random_seed = result.random_seed
+        self._set_population(result)
 
         self.var_loss = result.var_loss
         self.get_info = None if result.get_info == 'none' else result.get_info
@@ -258,11 +306,20 @@ class Options:
     def output_fname(self, epoch):
         return self.model_fname(epoch)
 
+    def checkpoint_fnames(self):
+        """
+        returns a list of pairs (epoch, path) for all checkpoints saved in the model
+        directory, sorted by epoch (the final checkpoint, if any, comes last)
+        """
+        return checkpoint_paths(self.path_for(self.model_dir))
+
     def input_fname(self):
         if self.resume_ckpt:
             return self.resume_ckpt
 
-        return tf.train.latest_checkpoint(self.path_for(self.model_dir))
+        # read from the checkpoint state file: tools which just read the options do
+        # not pay for importing TF
+        return latest_checkpoint(self.path_for(self.model_dir))
 
     def log_fname(self):
         return self.path_for('logdir/logs')
@@ -277,6 +334,14 @@ class Options:
         _, step = spec[0]
         return epoch % step == 0
 
+    def keep_checkpoint_at_epoch(self, epoch):
+        """
+        returns true if the checkpoint saved at the given epoch is to be kept
+        regardless of self.keep_checkpoints (i.e., epoch is an end-point of the
+        save schedule)
+        """
+        return any(epoch == epoch_range.stop for epoch_range, _ in self._epoch_save_ranges[:-1])
+
     def config_struct(self):
         return vars(self.used_options)
 
@@ -289,6 +354,9 @@ class Options:
                             ", where Ei is the i-th end-point and Ni is the frequency in the given range. "
                             "For instance: 100:10-1000:100-5000:200 says to save models every 10 epochs from epochs in range"
                             " 1:100 every 100 epochs for epochs in range 101:1000, and every 200 epochs for epochs in 1000:5000")                            
+        parser.add_argument('--keep-checkpoints', type=int, metavar="K",
+                            help="Keep only the last K checkpoints (besides the final one and the ones saved at the "
+                            "end-points of the save schedule). By default all checkpoints are kept.")
         parser.add_argument('-i', '--resume-ckpt', type=str,
                             help="Resume operations from the given ckpt, resume latest ckpt if not provided.")
         parser.add_argument('-H', '--hidden-layers',
@@ -303,6 +371,15 @@ class Options:
                             help='Evaluate all stats and print the result on the console (if set training options will be ignored)')
         parser.add_argument('-E', '--eval-data', metavar="PATH", type=str, 
                             help='Evaluate the current model on the whole dataset and save it to disk. Specifically a line (N(x),s,y) is saved for each example (x,s,y), where N(x) is the value computed on the last layer of "model" network.')
+        parser.add_argument('--eval-batch-size', type=int, metavar="N",
+                            help="Number of examples processed at once when computing representations (-E), defaults to "
+                            "{}. Use 0 to process each split at once.".format(self.EVAL_BATCH_SIZE))
+        parser.add_argument('--representation-format', choices=['npz', 'csv'],
+                            help="Format of the files written by -E: 'npz' (default) stores the h, s and y columns as binary "
+                            "arrays; 'csv' writes a text table with columns h_*, s_*, y_*.")
+        parser.add_argument('--export-all-checkpoints', action='store_const', const=True, default=False,
+                            help='Save the representations (as with -E) built by each checkpoint in the model directory: the dataset '
+                            'is loaded and the model is built only once. Representations are saved to PATH-EPOCH_{train,val,test}.npz (or .csv).')
         parser.add_argument('-s', '--schedule', type=str,
                             help="Specifies how to schedule training epochs (see the main description for more information.)")
         parser.add_argument('-f', '--fairness-importance', type=float,
@@ -315,6 +392,24 @@ class Options:
                             help="Specifies the (initial) learning rate")
         parser.add_argument('-g', '--get-info', choices=['epoch', 'variables', 'data-sample', 'out-sample',
                                                          'none'], default='none', help="Returns a textual representation of model parameters")
+        parser.add_argument('--train-step', choices=['separate', 'fused', 'simultaneous'],
+                            help="How to perform the s, y and h training steps on each batch: 'separate' (default) runs them one "
+                            "after the other; 'fused' runs them in a single call with the same semantics, computing the hidden "
+                            "representation only once; 'simultaneous' computes all gradients before applying any of them.")
+        parser.add_argument('--eval-every', type=int, metavar="N",
+                            help="Evaluate the model on the validation set (for tensorboard stats) every N epochs (defaults to 1). "
+                            "Training stats are computed while training, at no additional cost.")
+        parser.add_argument('--tf2', action='store_const', const=True, default=False,
+                            help="Use the native TF2 implementation of the model (checkpoints written by the default one can be restored).")
+        parser.add_argument('--no-jit-compile', action='store_const', const=True, default=False,
+                            help="Do not compile the TF2 training step with XLA (only meaningful with --tf2).")
+        parser.add_argument('--population-fairness', type=str, metavar="F1,F2,...",
+                            help="Train a population of networks in a single graph (see fair.fn.population_model), one for "
+                            "each of the given (comma separated) fairness importances.")
+        parser.add_argument('--population-seeds', type=str, metavar="S1,S2,...",
+                            help="Random seeds of the networks in the population, used for their noise and initial weights (defaults "
+                            "to RANDOM_SEED, RANDOM_SEED+1, ...). The initial weights of a network do not depend on the other "
+                            "networks in the population, but differ from the ones of a standalone run with the same seed.")
         parser.add_argument('-V', '--var-loss', action='store_const', const=True, default=False,
                             help="Use the s_loss variance (instead of the mean) to train the common layers.")
         parser.add_argument('-v', '--verbose', type=bool, default=False,
@@ -325,6 +420,13 @@ class Options:
                             help="Sets the initializer function for the bias term, defaults to glorot_uniform if not given or set to 'default'")
         parser.add_argument('--noise-type', choices=["default", "sigmoid_full", "sigmoid_sep", "sigmoid_sep_2"], 
                             help="Choose the type of activation used after the noise layer.")
+        parser.add_argument('--noise-resample', action='store_const', const=True, default=False,
+                            help="Draw new noise for each example at every epoch (by default each example gets the same noise "
+                            "at every epoch). Noise is generated from the random seed, hence it is reproducible in both cases.")
+        parser.add_argument('--no-dataset-cache', action='store_const', const=True, default=False,
+                            help="Do not read (nor write) the preprocessed dataset from the on-disk dataset cache.")
+        parser.add_argument('--streaming-load', action='store_const', const=True, default=False,
+                            help="Read the dataset in chunks, encoding it directly into the dataset cache (for datasets not fitting into memory).")
         parser.add_argument('--log-level', choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
         parser.add_argument('--log-file', type=str, help="Specifies the file to save logs, defaults to stdout")
 
@@ -358,22 +460,22 @@ class Options:
                 'Cannot parse layer specification for element:' + spec)
 
         if match.group(1) == None or match.group(1) == 's':
-            return tf.nn.sigmoid
+            return self.ACTIVATIONS['sigmoid']
 
         if match.group(1) == 'l':
             return None
 
         if match.group(1) == 'r':
-            return tf.nn.relu
+            return self.ACTIVATIONS['relu']
 
         if match.group(1) == 'e':
-            return tf.nn.leaky_relu
+            return self.ACTIVATIONS['leaky_relu']
 
         if match.group(1) == 'h':
-            return tf.nn.tanh
+            return self.ACTIVATIONS['tanh']
 
         if match.group(1) == 'i':
-            return tf.identity
+            return self.ACTIVATIONS['identity']
 
         if match.group(1) == 'n':
             return None
@@ -381,7 +483,7 @@ class Options:
         if match.group(1) == 'w':
             # if we want a whiteout layer, it is going to have sigmoids. this is not ideal,
             # but sigmoids are all we are using in the paper-reported experiments.
-            return tf.nn.sigmoid 
+            return self.ACTIVATIONS['sigmoid'] 
 
         raise ParseError(
             'Error in parsing layer specification for element:' + spec + '. This is a bug.')
@@ -496,14 +598,56 @@ class Options:
 
     def _set_noise_type(self, result):
         self.noise_type = getattr(result, 'noise_type', 'default')
+        self.noise_resample = getattr(result, 'noise_resample', False)
 
         logging.debug('Using noise type: {}'.format(self.noise_type))
 
 
+    def _set_population(self, result):
+        fairnesses = getattr(result, 'population_fairness', None)
+        seeds = getattr(result, 'population_seeds', None)
+
+        if fairnesses == None and seeds == None:
+            self.population = None
+            return
+
+        # values read from the json config can be lists already
+        fairnesses = self._parse_list(fairnesses, float)
+        seeds = self._parse_list(seeds, int)
+
+        if fairnesses == None:
+            fairnesses = [self.fairness_importance] * len(seeds)
+        if seeds == None:
+            random_seed = self.random_seed if self.random_seed != None else 42
+            seeds = [random_seed + index for index in range(len(fairnesses))]
+
+        if len(fairnesses) != len(seeds):
+            raise ParseError("--population-fairness and --population-seeds specify populations of different sizes ({} and {})".format(
+                len(fairnesses), len(seeds)))
+
+        if self.tf2:
+            raise ParseError("population training is not supported by the TF2 model (--tf2)")
+
+        self.population = list(zip(fairnesses, seeds))
+        logging.debug('Training a population of {} networks: {}'.format(len(self.population), self.population))
+
+    def _parse_list(self, values, type):
+        if values == None:
+            return None
+
+        if isinstance(values, str):
+            values = values.split(",")
+
+        return [type(value) for value in values]
+
     def _set_datasets(self, result):
         self.dataset_name = result.dataset
         self.dataset_base_path = self.path_for(result.dataset_base_path)
 
-        self.dataset = self.DATASETS[self.dataset_name](self.dataset_base_path)
+        self.use_dataset_cache = not getattr(result, 'no_dataset_cache', False)
+        self.streaming_load = getattr(result, 'streaming_load', False)
+
+        self.dataset = import_class(self.DATASETS[self.dataset_name])(self.dataset_base_path, use_cache=self.use_dataset_cache,
+                                                        streaming=self.streaming_load)
         self.num_features = self.dataset.num_features()
 
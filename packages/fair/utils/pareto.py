@@ -0,0 +1,139 @@
+import numpy as np
+
+
+def summary_objectives(summary, with_mi=True):
+    """
+    returns the objectives (all to be maximized) of the performances summarized by
+    summary (see pareto_scores.results_summary): the fraction of possible gain on y,
+    the fraction of possible gain in unpredictability of s (see
+    pareto_scores.results_score) and, if with_mi, minus the mutual information
+    between s and the representation.
+    """
+    perf_y = _gain(summary['fny'], summary['mmy'], summary['ppy'])
+    perf_s = _gain(summary['fns'], summary['mms'], summary['pps'])
+
+    if with_mi:
+        return [perf_y, perf_s, -summary['mi']]
+
+    return [perf_y, perf_s]
+
+def _gain(value, worst, best):
+    """ fraction of the possible gain (from worst to best) achieved by value, nan if no gain is possible """
+    if best == worst:
+        return float('nan')
+
+    return (value - worst) / (best - worst)
+
+def _unique_rows(points):
+    """ returns (unique rows, index of the unique row of each point); nans are the worst values """
+    points = np.where(np.isnan(points), -np.inf, points)
+    return np.unique(points, axis=0, return_inverse=True)
+
+def _skyline_2d(points):
+    # sorted by decreasing x (and decreasing y for the same x), a point is on the
+    # front iff it is the first one or its y is greater than the y of all the points
+    # preceding it (the first one is kept even when its y is -inf, i.e., nan)
+    order = np.lexsort((-points[:, 1], -points[:, 0]))
+    ys = points[order, 1]
+    previous_max = np.concatenate([[-np.inf], np.maximum.accumulate(ys)[:-1]])
+    on_front = ys > previous_max
+    on_front[0] = True
+    return order[on_front]
+
+def _skyline_kd(points):
+    # sorted in decreasing lexicographic order, a point cannot be dominated by the
+    # ones following it: the front only grows while scanning the points
+    order = np.lexsort(tuple(-points[:, column] for column in reversed(range(points.shape[1]))))
+    front = []
+    for index in order:
+        if len(front) == 0 or not np.any(np.all(points[front] >= points[index], axis=1)):
+            front.append(index)
+
+    return np.array(front, dtype=np.int64)
+
+def pareto_front(points):
+    """
+    returns the (sorted) indices of the rows of points (an [n, k] array of objectives
+    to be maximized) which are not dominated by any other row; rows equal to a
+    non dominated one are returned as well. nan values are considered worse than any
+    other value.
+
+    The front is computed in O(n log n) for k <= 2 and in O(n f k) otherwise, f being
+    the size of the front.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim != 2:
+        raise ValueError("points must be a 2-D array, found shape {}".format(points.shape))
+
+    if points.shape[0] == 0:
+        return np.array([], dtype=np.int64)
+
+    unique, inverse = _unique_rows(points)
+
+    if unique.shape[1] == 1:
+        front = np.array([np.argmax(unique[:, 0])])
+    elif unique.shape[1] == 2:
+        front = _skyline_2d(unique)
+    else:
+        front = _skyline_kd(unique)
+
+    return np.flatnonzero(np.isin(inverse.reshape(-1), front))
+
+
+class ParetoFront:
+    """
+    Pareto front of a set of points (arrays of objectives to be maximized)
+    identified by keys, e.g. (experiment, epoch) pairs. Points can be added at any
+    time: the front is updated considering only the points currently on it and the
+    new ones, hence dominated points are not kept in memory.
+
+    Adding a point with a key already in the front replaces the old point; note that
+    points discarded because dominated by the replaced one are not reconsidered.
+    """
+
+    def __init__(self, num_objectives):
+        self.num_objectives = num_objectives
+        self.keys = []
+        self.points = np.empty((0, num_objectives))
+        # rowid of the last performances read from the results store (see refresh)
+        self.last_rowid = 0
+
+    def add(self, keys, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.num_objectives)
+        if len(keys) != points.shape[0]:
+            raise ValueError("{} keys given for {} points".format(len(keys), points.shape[0]))
+
+        new_keys = set(keys)
+        kept = [index for index, key in enumerate(self.keys) if key not in new_keys]
+        all_keys = [self.keys[index] for index in kept] + list(keys)
+        all_points = np.vstack([self.points[kept], points])
+
+        front = pareto_front(all_points)
+        self.keys = [all_keys[index] for index in front]
+        self.points = all_points[front]
+
+        return self
+
+    def refresh(self, store, classifier_id='forest', mi_id='mine'):
+        """
+        adds the epochs evaluated in the given results store (see
+        fair.utils.results_store) since the last refresh, with objectives computed by
+        summary_objectives (minus the mi is included iff the front has 3 objectives)
+        """
+        last_rowid = store.last_rowid()
+        summaries = store.summaries(classifier_id, mi_id, since_rowid=self.last_rowid)
+
+        if len(summaries) > 0:
+            with_mi = self.num_objectives == 3
+            self.add([(experiment, epoch) for experiment, epoch, _ in summaries],
+                     [summary_objectives(summary, with_mi) for _, _, summary in summaries])
+
+        self.last_rowid = last_rowid
+        return self
+
+    def front(self):
+        """ returns the list of (key, objectives) pairs of the points on the front """
+        return list(zip(self.keys, self.points.tolist()))
+
+    def __len__(self):
+        return len(self.keys)
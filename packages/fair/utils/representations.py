@@ -0,0 +1,189 @@
+import os
+import re
+import shutil
+import logging
+import itertools
+import zipfile
+import numpy as np
+import pandas
+import scipy.sparse
+
+FORMATS = ["npz", "csv"]
+SPLITS = ["train", "val", "test"]
+
+
+def representation_path(path_prefix, split, fmt="npz"):
+    """
+    Returns the path of the file storing the given split of the representation
+    saved with the given path prefix (e.g., PREFIX_train.npz)
+    """
+    return "{}_{}.{}".format(path_prefix, split, fmt)
+
+def row_chunks(xs, chunk_size):
+    """
+    Yields consecutive blocks of (at most) chunk_size rows of xs (a numpy array or a
+    scipy.sparse matrix); xs is yielded as it is when chunk_size is None.
+    """
+    if chunk_size == None:
+        yield xs
+        return
+
+    for start in range(0, xs.shape[0], chunk_size):
+        yield xs[start:start+chunk_size]
+
+def save_representation(path_prefix, split, h, s, y, fmt="npz"):
+    """
+    Saves the representation h of a split of the dataset (along with its s and y
+    columns) and returns the path of the written file.
+
+    The npz format stores the three column groups as separate (uncompressed) arrays,
+    so that they can be loaded without any parsing (a sparse h is stored as a CSR
+    matrix, i.e., as its data, indices and indptr arrays); the csv format writes a
+    single table with columns h_0...h_n, s_0...s_m, y_0...y_k.
+    """
+    return save_representation_chunks(path_prefix, split, [h], s, y, fmt)
+
+def save_representation_chunks(path_prefix, split, h_chunks, s, y, fmt="npz"):
+    """
+    Same as save_representation, but h is given as an iterable over consecutive
+    blocks of its rows (e.g., computed batch by batch): each block is written as
+    soon as it is produced, so that the whole representation is never in memory.
+    """
+    assert fmt in FORMATS, "unknown representation format: {}".format(fmt)
+
+    to_path = representation_path(path_prefix, split, fmt)
+    os.makedirs(os.path.dirname(to_path) or ".", exist_ok=True)
+    h_chunks = iter(h_chunks)
+    first = next(h_chunks)
+
+    if fmt == "npz" and scipy.sparse.issparse(first):
+        h = scipy.sparse.vstack([first] + list(h_chunks), format="csr")
+        _write_sparse_npz(to_path, h, np.asarray(s), np.asarray(y))
+        return to_path
+
+    chunks = (chunk.toarray() if scipy.sparse.issparse(chunk) else np.asarray(chunk) for chunk in itertools.chain([first], h_chunks))
+
+    if fmt == "npz":
+        _write_npz(to_path, chunks, np.asarray(s), np.asarray(y))
+        return to_path
+
+    start = 0
+    for chunk in chunks:
+        end = start + chunk.shape[0]
+        h_header = ["h_"+str(index) for index in range(chunk.shape[1])]
+        s_header = ["s_"+str(index) for index in range(s.shape[1])]
+        y_header = ["y_"+str(index) for index in range(y.shape[1])]
+        pandas.DataFrame(np.hstack((chunk, s[start:end], y[start:end])), columns=h_header + s_header + y_header).to_csv(
+            to_path, index=False, header=(start == 0), mode="w" if start == 0 else "a")
+        start = end
+
+    return to_path
+
+def load_representation(path):
+    """
+    Loads a representation saved by save_representation (in either format) and
+    returns the tuple (h, s, y); h is a scipy.sparse CSR matrix if it was saved as such.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            if "h.indptr" in data.files:
+                h = scipy.sparse.csr_matrix((data["h.data"], data["h.indices"], data["h.indptr"]), shape=tuple(data["h.shape"]))
+                return h, data["s"], data["y"]
+
+            return data["h"], data["s"], data["y"]
+
+    df = pandas.read_csv(path)
+    return df.filter(regex="h.*").values, df.filter(regex="s.*").values, df.filter(regex="y.*").values
+
+def list_representations(dir):
+    """
+    Returns a dictionary mapping the name of each representation saved in dir to a
+    dictionary mapping each split to the path of the corresponding file. When a
+    representation has been saved in both formats, the npz files are used.
+    """
+    result = {}
+    for fname in sorted(os.listdir(dir)):
+        match = re.match(r"^(.*)_(train|val|test)\.(npz|csv)$", fname)
+        if match == None:
+            continue
+
+        name, split, fmt = match.groups()
+        paths = result.setdefault(name, {})
+        if split not in paths or fmt == "npz":
+            paths[split] = os.path.join(dir, fname)
+
+    for name, paths in list(result.items()):
+        if set(paths.keys()) != set(SPLITS):
+            logging.warning("Skipping representation {}: missing splits {}".format(name, set(SPLITS) - set(paths.keys())))
+            del result[name]
+
+    return result
+
+def exported_representations(dir, name="fair_networks_repr"):
+    """
+    Returns a dictionary mapping the epoch of each checkpoint whose representations
+    have been written into dir by fair_networks --export-all-checkpoints (as
+    NAME-EPOCH_SPLIT.npz) to the sorted list of their member suffixes: '' for a
+    single network, '_member<k>' for each network of a population (whose
+    representations are written as NAME-EPOCH_member<k>_SPLIT.npz).
+    """
+    result = {}
+    regexp = r"^{}-([^_]+)(_member\d+)?_train\.npz$".format(re.escape(name))
+    for fname in sorted(os.listdir(dir)) if os.path.isdir(dir) else []:
+        match = re.match(regexp, fname)
+        if match == None:
+            continue
+
+        epoch, member = match.groups()
+        result.setdefault(epoch, []).append(member or "")
+
+    return result
+
+def copy_exported_representations(exported_dir, dir, epoch, name="fair_networks_repr"):
+    """
+    Copies the representations exported into exported_dir for the given epoch (see
+    exported_representations) into dir, where test_representations evaluates them
+    as NAME (or NAME_member<k> for each network of a population). Returns the names
+    of the copied representations; raises FileNotFoundError when there are none.
+    """
+    members = exported_representations(exported_dir, name).get(str(epoch), [])
+    if len(members) == 0:
+        raise FileNotFoundError("no representations of epoch {} in {}".format(epoch, exported_dir))
+
+    for member in members:
+        for split in SPLITS:
+            shutil.copy(representation_path(os.path.join(exported_dir, "{}-{}{}".format(name, epoch, member)), split),
+                        representation_path(os.path.join(dir, name + member), split))
+
+    return [name + member for member in members]
+
+def _write_npz(to_path, h_chunks, s, y):
+    # same layout written by np.savez, but h is written one chunk at a time
+    first = next(h_chunks)
+    header = {
+        "descr": np.lib.format.dtype_to_descr(first.dtype),
+        "fortran_order": False,
+        "shape": (s.shape[0], first.shape[1])
+    }
+
+    with zipfile.ZipFile(to_path, "w", allowZip64=True) as archive:
+        with archive.open("h.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            f.write(np.ascontiguousarray(first).tobytes())
+            for chunk in h_chunks:
+                f.write(np.ascontiguousarray(chunk, dtype=first.dtype).tobytes())
+
+        _write_arrays(archive, [("s", s), ("y", y)])
+
+def _write_sparse_npz(to_path, h, s, y):
+    # same components stored by DatasetCache for sparse matrices, plus the shape
+    arrays = [("h.data", h.data), ("h.indices", h.indices), ("h.indptr", h.indptr), ("h.shape", np.array(h.shape)),
+              ("s", s), ("y", y)]
+
+    with zipfile.ZipFile(to_path, "w", allowZip64=True) as archive:
+        _write_arrays(archive, arrays)
+
+def _write_arrays(archive, arrays):
+    for name, array in arrays:
+        with archive.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array)
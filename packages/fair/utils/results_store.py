@@ -0,0 +1,190 @@
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment TEXT PRIMARY KEY,
+    commit_id TEXT,
+    config TEXT
+);
+
+CREATE TABLE IF NOT EXISTS performances (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    experiment TEXT NOT NULL,
+    epoch TEXT NOT NULL,
+    representation TEXT NOT NULL,
+    classifier TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    value REAL,
+    UNIQUE (experiment, epoch, representation, classifier, variable, measure)
+);
+
+CREATE INDEX IF NOT EXISTS performances_by_classifier
+    ON performances (classifier, measure);
+"""
+
+# the fair representation is summarized along with the baselines computed at the
+# same epoch: a population stores one fair representation per member
+# (fair_networks_repr_member<k>), each summarized on its own
+SUMMARY_QUERY = """
+WITH selected AS (
+    SELECT experiment, epoch, representation, classifier, variable, measure, value
+    FROM performances
+    WHERE ((classifier = :classifier AND measure = 'val') OR (classifier = :mi AND measure = 'train'))
+        {experiment_filter}
+        {since_filter}
+), baselines AS (
+    SELECT experiment, epoch,
+        MAX(CASE WHEN classifier = :classifier AND variable = 'y' AND representation = 'original_repr' THEN value END) AS ppy,
+        MAX(CASE WHEN classifier = :classifier AND variable = 'y' AND representation = 'random_networks_repr' THEN value END) AS mmy,
+        MAX(CASE WHEN classifier = :classifier AND variable = 's' AND representation = 'random_networks_repr' THEN value END) AS pps,
+        MAX(CASE WHEN classifier = :classifier AND variable = 's' AND representation = 'original_repr' THEN value END) AS mms
+    FROM selected
+    GROUP BY experiment, epoch
+), fair AS (
+    SELECT experiment, epoch, representation,
+        MAX(CASE WHEN classifier = :classifier AND variable = 'y' THEN value END) AS fny,
+        MAX(CASE WHEN classifier = :classifier AND variable = 's' THEN value END) AS fns,
+        MAX(CASE WHEN classifier = :mi AND variable = 's' AND measure = 'train' THEN value END) AS mi
+    FROM selected
+    WHERE representation = 'fair_networks_repr' OR representation GLOB 'fair_networks_repr_member[0-9]*'
+    GROUP BY experiment, epoch, representation
+)
+SELECT fair.experiment || SUBSTR(fair.representation, LENGTH('fair_networks_repr') + 1), fair.epoch,
+    fny, ppy, mmy, fns, pps, mms, mi
+FROM fair JOIN baselines ON fair.experiment = baselines.experiment AND fair.epoch = baselines.epoch
+"""
+
+SUMMARY_KEYS = ['fny', 'ppy', 'mmy', 'fns', 'pps', 'mms', 'mi']
+
+PERFORMANCE_COLUMNS = "experiment, epoch, representation, classifier, variable, measure, value"
+
+
+class ResultsStore:
+    """
+    Stores the performances computed by test_representations for every experiment
+    and epoch in a SQLite database, one row per (experiment, epoch, representation,
+    classifier, variable, measure), where measure is one of the splits (train, val,
+    test) or 'discr'.
+
+    The database is opened in WAL mode, so that it can be read while experiments
+    processed in parallel write to it (concurrent writers wait for each other up to
+    timeout seconds).
+
+    Performances are numbered by an autoincrement id: ids are never reused, not even
+    for the performances of an epoch stored again, hence the performances stored
+    after a given one are exactly those with a greater id (see last_rowid).
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade_schema()
+        self.connection.executescript(SCHEMA)
+
+    def add_performances(self, experiment, epoch, performances, commit_id=None, config=None):
+        """
+        stores (replacing previous ones, if any) the performances computed at the
+        given epoch of the experiment. performances is formatted as the 'performances'
+        entry of the files written by test_representations.
+        """
+        rows = [(experiment, str(epoch), representation, classifier, variable, measure, value)
+                for representation, classifiers in performances.items()
+                for classifier, variables in classifiers.items()
+                for variable, measures in variables.items()
+                for measure, value in measures.items()]
+
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO experiments VALUES (?, ?, ?)",
+                                    (experiment, commit_id, json.dumps(config) if config != None else None))
+            self.connection.execute("DELETE FROM performances WHERE experiment = ? AND epoch = ?", (experiment, str(epoch)))
+            self.connection.executemany("INSERT INTO performances ({}) VALUES (?, ?, ?, ?, ?, ?, ?)".format(PERFORMANCE_COLUMNS), rows)
+
+    def has_performances(self, experiment, epoch):
+        cursor = self.connection.execute("SELECT 1 FROM performances WHERE experiment = ? AND epoch = ? LIMIT 1",
+                                         (experiment, str(epoch)))
+        return cursor.fetchone() != None
+
+    def experiments(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT experiment FROM performances ORDER BY experiment")]
+
+    def epochs(self, experiment):
+        return [row[0] for row in self.connection.execute(
+            "SELECT DISTINCT epoch FROM performances WHERE experiment = ?", (experiment,))]
+
+    def performances(self, experiment, epoch):
+        """
+        returns the performances stored for the given epoch of the experiment, in the
+        same format accepted by add_performances (in the same order they were given)
+        """
+        result = {}
+        cursor = self.connection.execute(
+            "SELECT representation, classifier, variable, measure, value FROM performances WHERE experiment = ? AND epoch = ? "
+            "ORDER BY id", (experiment, str(epoch)))
+
+        for representation, classifier, variable, measure, value in cursor:
+            result.setdefault(representation, {}).setdefault(classifier, {}).setdefault(variable, {})[measure] = value
+
+        return result
+
+    def last_rowid(self):
+        """ returns the id of the last stored performance (ids grow as performances are added) """
+        return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM performances").fetchone()[0]
+
+    def summaries(self, classifier_id='forest', mi_id='mine', experiment=None, since_rowid=None):
+        """
+        returns, for each epoch of each experiment (or of the given one), the tuple
+        (experiment, epoch, summary), where summary is the dictionary computed by
+        pareto_scores.results_summary (with the same classifier_id and mi_id) on the
+        corresponding performances. Each member of a population is summarized on its
+        own, as the experiment EXPERIMENT_member<k>. Epochs missing some of the representations are
+        skipped, the mi of epochs missing the mi_id estimate is nan. If since_rowid is
+        given, only the epochs stored after the performance with that id (see
+        last_rowid) are returned.
+        """
+        params = {'classifier': classifier_id, 'mi': mi_id}
+        experiment_filter = ""
+        if experiment != None:
+            experiment_filter = "AND experiment = :experiment"
+            params['experiment'] = experiment
+
+        since_filter = ""
+        if since_rowid != None:
+            since_filter = "AND (experiment, epoch) IN (SELECT experiment, epoch FROM performances WHERE id > :since)"
+            params['since'] = since_rowid
+
+        result = []
+        query = SUMMARY_QUERY.format(experiment_filter=experiment_filter, since_filter=since_filter)
+        for row in self.connection.execute(query, params):
+            values = [float('nan') if value == None else value for value in row[2:]]
+            if None in row[2:-1]:
+                continue
+            result.append((row[0], row[1], dict(zip(SUMMARY_KEYS, values))))
+
+        return result
+
+    def close(self):
+        self.connection.close()
+
+    # PRIVATE METHODS
+
+    def _upgrade_schema(self):
+        """
+        moves the performances of stores written before performances had an
+        autoincrement id (whose rowids could be reused) into the current table
+        """
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(performances)")]
+        if len(columns) == 0 or 'id' in columns:
+            return
+
+        with self.connection:
+            self.connection.execute("ALTER TABLE performances RENAME TO old_performances")
+            self.connection.execute("DROP INDEX IF EXISTS performances_by_classifier")
+            for statement in SCHEMA.split(";"):
+                self.connection.execute(statement)
+            self.connection.execute("INSERT INTO performances ({columns}) SELECT {columns} FROM old_performances ORDER BY rowid".format(
+                columns=PERFORMANCE_COLUMNS))
+            self.connection.execute("DROP TABLE old_performances")
@@ -0,0 +1,34 @@
+import numpy as np
+import scipy.sparse
+
+
+def _coo_parts(matrix):
+    coo = matrix.tocoo()
+    indices = np.vstack([coo.row, coo.col]).T.astype(np.int64)
+    return indices, coo.data.astype(np.float32), np.array(coo.shape, dtype=np.int64)
+
+def to_sparse_tensor(matrix):
+    """
+    Converts a scipy.sparse matrix into a tf.SparseTensor (e.g., to be sliced by tf.data)
+    """
+    import tensorflow as tf
+    indices, values, dense_shape = _coo_parts(matrix)
+    return tf.sparse.reorder(tf.SparseTensor(indices=indices, values=values, dense_shape=dense_shape))
+
+def to_sparse_tensor_value(matrix):
+    """
+    Converts a scipy.sparse matrix into a value that can be fed to a sparse placeholder
+    """
+    import tensorflow as tf
+    indices, values, dense_shape = _coo_parts(matrix)
+    return tf.compat.v1.SparseTensorValue(indices, values, dense_shape)
+
+def feed_value(xs):
+    """
+    Returns xs in a format suitable to be fed to the model input: scipy.sparse matrices
+    are converted to SparseTensorValue, everything else is returned unchanged.
+    """
+    if scipy.sparse.issparse(xs):
+        return to_sparse_tensor_value(xs)
+
+    return xs
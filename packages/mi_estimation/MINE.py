@@ -1,67 +1,160 @@
 import tensorflow as tf
-import tensorflow.contrib.layers as layers
 import math
 import numpy as np
 
 class MINE():
+    """
+    Mutual Information Neural Estimator (Belghazi et al., 2018): estimates the mutual
+    information between x and y as the lower bound E[T(x,y)] - log E[exp(T(x,y'))]
+    maximized over a statistics network T, where y' is drawn from the marginal
+    distribution (i.e., y shuffled with respect to x).
 
-    def __init__(self, x, y, hidden_neurons=50, learning_rate=1e-3):
-        self.x = x 
+    Each instance builds its network in its own graph (and session), so that
+    creating several estimators does not grow the default graph. Training data is
+    shuffled and batched in-graph (tf.data); gradients are bias corrected using a
+    moving average of the denominator of the bound, and training stops early once
+    the estimate on a held-out part of the data stops improving (the weights giving
+    the best held-out estimate are then restored).
+    """
+
+    def __init__(self, x, y, hidden_neurons=50, learning_rate=1e-3, ma_rate=0.01, holdout_fraction=0.1, random_seed=None):
+        self.x = x
         self.y = y
         self.hidden_neurons = hidden_neurons
         self.learning_rate = learning_rate
+        self.ma_rate = ma_rate
+        self.holdout_fraction = holdout_fraction
+        self.random_seed = random_seed
+        self.graph = tf.Graph()
+        self.sess = None
         self.create_mine()
 
     def create_mine(self):
         x_size = self.x.shape[1]
         y_size = self.y.shape[1]
 
-        self.x_in = tf.placeholder(tf.float32, [None, x_size], name='mine_x_ph')
-        self.y_in = tf.placeholder(tf.float32, [None, y_size], name='mine_y_ph')
+        with self.graph.as_default():
+            if self.random_seed != None:
+                tf.compat.v1.set_random_seed(self.random_seed)
+
+            self.x_in = tf.compat.v1.placeholder(tf.float32, [None, x_size], name='mine_x_ph')
+            self.y_in = tf.compat.v1.placeholder(tf.float32, [None, y_size], name='mine_y_ph')
+            self.batch_size = tf.compat.v1.placeholder(tf.int64, [], name='mine_batch_size_ph')
+
+            # training data is fed once (when the iterator is initialized), then it is
+            # shuffled (again at each epoch) and batched in-graph
+            data = tf.data.Dataset.from_tensor_slices((self.x_in, self.y_in))
+            data = data.shuffle(tf.shape(self.x_in, out_type=tf.int64)[0], reshuffle_each_iteration=True)
+            data = data.batch(self.batch_size).repeat()
+            self.iterator = tf.compat.v1.data.make_initializable_iterator(data)
+            x_batch, y_batch = self.iterator.get_next()
+
+            # the estimate on the data fed to the placeholders
+            self.mi = self.lower_bound(*self.statistics(self.x_in, self.y_in))
+
+            # bias corrected gradient: the denominator of the gradient of the log term is
+            # replaced by its moving average
+            T_xy, T_x_y = self.statistics(x_batch, y_batch)
+            exp_mean = tf.reduce_mean(tf.math.exp(T_x_y))
+            moving_average = tf.compat.v1.Variable(1.0, trainable=False, name='mine_moving_average')
+            updated_average = tf.compat.v1.assign(moving_average, (1.0 - self.ma_rate) * moving_average + self.ma_rate * tf.stop_gradient(exp_mean))
+
+            # compute the negative loss (maximise loss == minimise -loss)
+            self.neg_loss = -(tf.reduce_mean(T_xy) - exp_mean / tf.stop_gradient(updated_average))
+            self.opt = tf.compat.v1.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.neg_loss)
+
+            # copy of the weights giving the best held-out estimate (see train)
+            weights = tf.compat.v1.trainable_variables()
+            best_weights = [tf.compat.v1.Variable(tf.zeros(weight.shape), trainable=False, name='mine_best_' + weight.op.name.replace('/', '_'))
+                            for weight in weights]
+            self.save_best = tf.group(*[best.assign(weight) for best, weight in zip(best_weights, weights)])
+            self.restore_best = tf.group(*[weight.assign(best) for best, weight in zip(best_weights, weights)])
+
+            self.init = tf.compat.v1.global_variables_initializer()
+
+    def statistics(self, x, y):
+        """
+        returns the outputs of the statistics network on the pairs (x,y) (samples of
+        the joint distribution) and on the pairs (x,y') where y' is y shuffled
+        (samples of the product of the marginals)
+        """
+        y_shuffle = tf.random.shuffle(y)
+        x_conc = tf.concat([x, x], axis=0)
+        y_conc = tf.concat([y, y_shuffle], axis=0)
 
-        # shuffle and concatenate
-        y_shuffle = tf.random_shuffle(self.y_in)
-        x_conc = tf.concat([self.x_in, self.x_in], axis=0)
-        y_conc = tf.concat([self.y_in, y_shuffle], axis=0)
-        
         # propagate the forward pass
-        layerx = layers.linear(x_conc, self.hidden_neurons)
-        layery = layers.linear(y_conc, self.hidden_neurons)
-        layer2 = tf.nn.relu(layerx + layery)
-        self.output = layers.linear(layer2, 1)
-        
+        with tf.compat.v1.variable_scope('mine', reuse=tf.compat.v1.AUTO_REUSE):
+            layerx = tf.compat.v1.layers.dense(x_conc, self.hidden_neurons, name='layer_x')
+            layery = tf.compat.v1.layers.dense(y_conc, self.hidden_neurons, name='layer_y')
+            layer2 = tf.nn.relu(layerx + layery)
+            output = tf.compat.v1.layers.dense(layer2, 1, name='output')
+
         # split in T_xy and T_x_y predictions
-        N_samples = tf.shape(self.x_in)[0]
-        T_xy = self.output[:N_samples]
-        T_x_y = self.output[N_samples:]
-        
-        # compute the negative loss (maximise loss == minimise -loss)
-        self.neg_loss = -(tf.reduce_mean(T_xy, axis=0) - tf.math.log(tf.reduce_mean(tf.math.exp(T_x_y))))
-        self.opt = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.neg_loss)
-
-
-    def train(self, epochs=500, batch_size=64):
-        num_batches = math.ceil(self.x.shape[0]/batch_size)
-        self.sess = tf.Session()
-        self.sess.run(tf.global_variables_initializer())
-        for epoch in range(epochs):
-            x_epoch, y_epoch = self.shuffle_together(self.x, self.y)
-            for i in range(num_batches):
-                start = i * batch_size
-                end   = (i+1) * batch_size
-                x_batch = x_epoch[start:end]
-                y_batch = y_epoch[start:end]
-                feed_dict = {self.x_in:x_batch, self.y_in:y_batch}
-                _, neg_l = self.sess.run([self.opt, self.neg_loss], feed_dict=feed_dict)
+        N_samples = tf.shape(x)[0]
+        return output[:N_samples], output[N_samples:]
+
+    def lower_bound(self, T_xy, T_x_y):
+        return tf.reduce_mean(T_xy) - tf.math.log(tf.reduce_mean(tf.math.exp(T_x_y)))
+
+    def train(self, epochs=500, batch_size=512, patience=10, min_delta=1e-3, min_epochs=20):
+        """
+        trains the statistics network for at most the given number of epochs,
+        stopping as soon as the estimate on the held-out data has not improved by
+        more than min_delta for patience epochs. The estimate is not monitored during
+        the first min_epochs epochs, since it usually drops before increasing (the
+        moving average of the bias correction needs a few epochs to settle); once it
+        is, the weights giving the best held-out estimate are kept.
+        Returns the number of epochs performed.
+        """
+        x_train, y_train, x_holdout, y_holdout = self.holdout_split(self.x, self.y)
+        holdout_feed = {self.x_in: x_holdout, self.y_in: y_holdout}
+        steps_per_epoch = int(math.ceil(len(x_train) / batch_size))
+
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+        self.sess.run(self.init)
+        self.sess.run(self.iterator.initializer, feed_dict={self.x_in: x_train, self.y_in: y_train, self.batch_size: batch_size})
+
+        best_mi = -np.inf
+        # best_mi is updated only by improvements greater than min_delta
+        saved_mi = -np.inf
+        epochs_without_improvement = 0
+        num_epochs = 0
+
+        while num_epochs < epochs:
+            for _ in range(steps_per_epoch):
+                self.sess.run(self.opt)
+            num_epochs += 1
+
+            if num_epochs < min_epochs:
+                continue
+
+            holdout_mi = self.sess.run(self.mi, feed_dict=holdout_feed)
+            if holdout_mi > saved_mi:
+                saved_mi = holdout_mi
+                self.sess.run(self.save_best)
+
+            if holdout_mi > best_mi + min_delta:
+                best_mi = holdout_mi
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+
+            if epochs_without_improvement >= patience:
+                break
+
+        if saved_mi > -np.inf:
+            self.sess.run(self.restore_best)
+
+        return num_epochs
 
     def estimate(self, x, y):
-        neg_l = self.sess.run(self.neg_loss, feed_dict={self.x_in: x, self.y_in: y})[0]
-        return -neg_l
+        return self.sess.run(self.mi, feed_dict={self.x_in: x, self.y_in: y})
 
-    def shuffle_together(self, a, b):
-        assert len(a) == len(b)
-        p = np.random.permutation(len(a))
-        return a[p], b[p]
+    def holdout_split(self, x, y):
+        assert len(x) == len(y)
+        p = np.random.RandomState(self.random_seed).permutation(len(x))
+        num_holdout = max(1, int(math.ceil(len(x) * self.holdout_fraction)))
+        return x[p[num_holdout:]], y[p[num_holdout:]], x[p[:num_holdout]], y[p[:num_holdout]]
 
     def close_session(self):
-        self.sess.close()
\ No newline at end of file
+        self.sess.close()
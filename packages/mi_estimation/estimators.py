@@ -0,0 +1,117 @@
+import numpy as np
+import scipy.special
+import scipy.spatial
+import sklearn.linear_model as lm
+
+# Non-neural estimators of the mutual information I(h;s) between a (continuous,
+# multi-dimensional) representation h and a discrete variable s, given as an array
+# of integer labels. All estimates are in nats, as the ones computed by MINE.
+
+ESTIMATORS = ["bins", "ksg", "classifier"]
+
+
+def entropy(labels):
+    """
+    returns the (plug-in) entropy of the distribution of the given integer labels
+    """
+    counts = np.bincount(labels)
+    p = counts[counts > 0] / len(labels)
+    return -np.sum(p * np.log(p))
+
+def binned_mi(h, s, bins=10):
+    """
+    Estimates I(h;s) by discretizing each column of h into the given number of
+    equal-width bins and computing the mutual information between s and the
+    resulting cells, from their contingency table: I = H(s) - H(s|cell).
+
+    The estimate is biased upwards when the cells are many with respect to the
+    examples (it tends to H(s) when each example falls in its own cell), so it is
+    mostly useful to compare representations of the same size.
+    """
+    h = np.asarray(h, dtype=np.float64)
+    low, high = h.min(axis=0), h.max(axis=0)
+    width = np.where(high > low, high - low, 1.0)
+    binned = np.minimum(((h - low) / width * bins).astype(np.int64), bins - 1)
+
+    _, cells = np.unique(binned, axis=0, return_inverse=True)
+    cells = cells.ravel()
+    num_labels = s.max() + 1
+
+    joint = np.bincount(cells * num_labels + s, minlength=(cells.max() + 1) * num_labels)
+    joint = joint.reshape(-1, num_labels) / len(s)
+    p_cell = joint.sum(axis=1, keepdims=True)
+    p_s = joint.sum(axis=0, keepdims=True)
+
+    nonzero = joint > 0
+    return np.sum(joint[nonzero] * np.log(joint[nonzero] / (p_cell * p_s)[nonzero]))
+
+def ksg_mi(h, s, k=3):
+    """
+    Estimates I(h;s) using the k-nearest neighbours estimator of Kraskov, Stoegbauer
+    and Grassberger adapted to a discrete s (Ross, 2014; the same estimator used by
+    sklearn.feature_selection.mutual_info_classif on single features):
+
+        I = psi(N) - <psi(N_s)> + psi(k) - <psi(m)>
+
+    where, for each example, N_s is the number of examples with its label and m is
+    the number of examples (of any label) closer than its k-th neighbour among the
+    ones with the same label. Distances are measured in the max-norm, using KD-trees.
+    As in sklearn, k is reduced for labels with at most k examples (psi(k) becoming
+    the mean of the per example values) and examples whose label occurs only once are
+    discarded.
+    """
+    h = np.asarray(h, dtype=np.float64)
+    s = np.asarray(s)
+    label_counts = np.bincount(s)
+
+    # examples with a unique label have no neighbour to measure a radius from
+    keep = label_counts[s] > 1
+    h, s = h[keep], s[keep]
+    n = len(s)
+    if n == 0:
+        return 0.0
+
+    label_counts = np.bincount(s)
+    radius = np.empty(n)
+    k_all = np.empty(n)
+
+    for label in np.nonzero(label_counts)[0]:
+        mask = s == label
+        # the k-th neighbour of a point is at position k, since the point itself is at 0
+        k_label = min(k, label_counts[label] - 1)
+        distances, _ = scipy.spatial.cKDTree(h[mask]).query(h[mask], k=k_label + 1, p=np.inf)
+        radius[mask] = distances[:, -1]
+        k_all[mask] = k_label
+
+    # examples strictly closer than the radius (the example itself included)
+    radius = np.nextafter(radius, 0)
+    m = scipy.spatial.cKDTree(h).query_ball_point(h, radius, p=np.inf, return_length=True)
+
+    result = (scipy.special.digamma(n) - np.mean(scipy.special.digamma(label_counts[s])) +
+              np.mean(scipy.special.digamma(k_all)) - np.mean(scipy.special.digamma(m)))
+    return max(result, 0.0)
+
+def classifier_mi(h_train, s_train, h_eval_list, s_eval_list, classifier=None):
+    """
+    Estimates I(h;s) as H(s) - CE, where CE is the cross-entropy of the predictions
+    of a probabilistic classifier of s (trained on h_train, s_train); since CE is an
+    upper bound to H(s|h), the estimate is a lower bound to I(h;s) (Barber and
+    Agakov, 2003), as tight as the classifier is accurate. H(s) is the entropy of the
+    training labels.
+
+    Returns the estimate on each of the pairs in h_eval_list, s_eval_list.
+    """
+    classifier = classifier if classifier != None else lm.LogisticRegression(solver="lbfgs")
+    classifier.fit(h_train, s_train)
+
+    h_s = entropy(s_train)
+    results = []
+    for h, s in zip(h_eval_list, s_eval_list):
+        # labels not seen while training have probability 0 (clipped, as in log_loss)
+        probabilities = np.zeros((len(s), max(classifier.classes_.max(), s.max()) + 1))
+        probabilities[:, classifier.classes_] = classifier.predict_proba(h)
+        p = probabilities[np.arange(len(s)), s]
+        cross_entropy = -np.mean(np.log(np.clip(p, 1e-15, 1.0)))
+        results.append(h_s - cross_entropy)
+
+    return results
@@ -2,7 +2,6 @@ import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 from scipy.io import loadmat
-from vfae_louizos.VFAE import VFAE
 from itertools import combinations
 from fair.datasets.adult_dataset import AdultDataset
 from fair.datasets.bank_marketing_dataset import BankMarketingDataset
@@ -90,6 +89,9 @@ def reverse_onehot(dataset):
 
 
 def main(args, use_MMD=True, use_s=True, random_seed=12345):
+    # theano is imported only here: other modules just need discrimination_noprob
+    from vfae_louizos.VFAE import VFAE
+
     dataset = args.dataset('./data')
     train_data, val_data, test_data = reverse_onehot(dataset)
     x_train, y_train, s_train = train_data